@@ -1,2 +1,43 @@
-from .xmltv import parse_xml, transfer_channel_ids, match_headend_to_internet, write_xml
-from .enricher import TMDBEnricher, TvMazeEnricher
+import importlib
+
+# Nothing is imported until it is first used, so touching epg_tool (or just building a
+# program) doesn't drag in lxml, fuzzywuzzy, pandas, tmdbsimple and requests.
+__exports = {
+    'parse_xml': 'xmltv',
+    'transfer_channel_ids': 'xmltv',
+    'match_headend_to_internet': 'xmltv',
+    'write_xml': 'xmltv',
+    'estimate_channel_offsets': 'xmltv',
+    'GenericEnricher': 'enricher',
+    'TMDBEnricher': 'enricher',
+    'TvMazeEnricher': 'enricher',
+    'enrich_programs': 'enricher',
+    'save_snapshot': 'snapshot',
+    'load_snapshot': 'snapshot',
+    'parse_xml_cached': 'snapshot',
+    'run_pipeline': 'pipeline',
+    'run_batch': 'batch',
+    'GuideDelta': 'delta',
+    'write_xml_delta': 'delta',
+    'SQLiteBroker': 'workqueue',
+    'run_worker': 'workqueue',
+    'enrich_distributed': 'workqueue',
+    'RunBudget': 'budget',
+    'EnrichmentUnavailable': 'budget',
+}
+
+# epg_tool.xmltv and friends still work without importing them first
+__submodules = set(__exports.values()) | {'channel', 'program', 'index', 'normalize', 'tvmaze', 'benchmark'}
+
+__all__ = list(__exports.keys())
+
+def __getattr__(name):
+    if name in __exports:
+        module = importlib.import_module('.' + __exports[name], __name__)
+        return getattr(module, name)
+    if name in __submodules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -0,0 +1,88 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from epg_tool.xmltv import parse_xml, transfer_channel_ids, match_headend_to_internet
+from epg_tool.delta import write_xml_delta
+from epg_tool.snapshot import parse_xml_cached, load_snapshot
+from epg_tool.enricher import enrich_programs, EnrichmentMemo
+
+def __snapshot_location(snapshot_dir, location):
+    name = hashlib.sha1(location.encode('utf-8')).hexdigest()
+    return os.path.join(snapshot_dir, '{}.snap'.format(name))
+
+def __parse_all(locations, snapshot_dir, max_workers):
+    # location -> (programs, channels, index) for every distinct guide, each parsed just the once.
+    # Fetching and parsing mostly waits on the network and lxml, so threads do fine here.
+    def parse(location):
+        if snapshot_dir is None:
+            return parse_xml(location)
+        return parse_xml_cached(location, __snapshot_location(snapshot_dir, location))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(locations, executor.map(parse, locations)))
+
+def __match_site(headend, internet, guides, snapshot_dir, engine):
+    # Runs in its own process. Snapshotted guides are mapped in again here rather than copied
+    # across, anything else arrives in guides. Either way this process has its own copy of the
+    # headend programs to write the matches into.
+    def load(location):
+        if location in guides:
+            return guides[location]
+        return load_snapshot(__snapshot_location(snapshot_dir, location))
+
+    tvhd_programs, tvhd_channels, _ = load(headend)
+    internet_programs, internet_channels, internet_index = load(internet)
+
+    tvhd_channels, tvhd_programs = transfer_channel_ids(tvhd_channels, tvhd_programs, internet_channels)
+    tvhd_programs, matches = match_headend_to_internet(tvhd_programs, internet_programs, internet_channels,
+                                                       internet_index, engine=engine)
+    return (list(tvhd_programs), tvhd_channels, len(matches))
+
+def run_batch(sites, movie_enricher, tv_enricher, snapshot_dir=None, engine='window', max_workers=4,
+              broker=None, timeout=None):
+    # sites are (headend guide, internet guide, output file), optionally followed by tvheadend's xmltv
+    # socket to push that site's changes to. Every distinct guide is parsed once, the sites are
+    # matched side by side in separate processes and then everything is enriched in one go through
+    # a single memo, so a show shared by every region is only looked up once. With a broker that
+    # one enrichment pass goes out to the workers instead.
+    locations = []
+    for site in sites:
+        for location in site[:2]:
+            if location not in locations:
+                locations.append(location)
+    guides = __parse_all(locations, snapshot_dir, max_workers)
+
+    # Matching is pure python and CPU bound, so each site gets a process of its own
+    def to_send(site):
+        if snapshot_dir is not None:
+            return {}
+        return {location: guides[location] for location in site[:2]}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(__match_site, site[0], site[1], to_send(site), snapshot_dir, engine)
+                   for site in sites]
+        matched = [future.result() for future in futures]
+
+    all_programs = []
+    for programs, _, _ in matched:
+        all_programs += programs
+    if broker is not None:
+        from epg_tool.workqueue import enrich_distributed
+        enriched, report = enrich_distributed(all_programs, broker, movie_enricher, tv_enricher, timeout=timeout)
+    else:
+        memo = EnrichmentMemo()
+        enriched, report = enrich_programs(all_programs, movie_enricher, tv_enricher, memo=memo)
+        report['memo_hit_rate'] = memo.hit_rate()
+
+    # Hand each site back its own programs, in order
+    first = 0
+    changed = 0
+    for (programs, channels, _), site in zip(matched, sites):
+        delta_report = write_xml_delta(enriched[first:first + len(programs)], channels, site[2],
+                                       socket_path=site[3] if len(site) > 3 else None)
+        changed += delta_report['changed']
+        first += len(programs)
+
+    report.update(sites=len(sites), guides_parsed=len(guides), programs=len(all_programs),
+                  matched=sum(n for _, _, n in matched), changed=changed)
+    return report
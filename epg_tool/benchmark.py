@@ -0,0 +1,283 @@
+import os
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+from epg_tool.channel import channel
+from epg_tool.program import program
+from epg_tool import xmltv
+
+# Run with: python -m epg_tool.benchmark --sizes 1000,10000,100000
+# Memory:   python -m epg_tool.benchmark --memory --sizes 1000,10000,100000 --budget 4000
+
+# Which of our files the traced memory of each structure is allocated from
+STRUCTURES = {'program objects': ['program.py', 'channel.py'],
+              'index': ['index.py', 'normalize.py']}
+
+TITLES = ['News', 'Gardening Australia', 'Bluey', 'Play School', 'Landline', 'Insiders',
+          'Back Roads', 'Hard Quiz', 'Gruen', 'Vera', 'Grand Designs', 'Antiques Roadshow',
+          'Midsomer Murders', 'Four Corners', 'Q+A', 'Escape From The City']
+
+def generate_guides(directory, n_programs, n_channels=20, offset=timedelta(minutes=7), seed=0):
+    # An internet guide and a headend guide of the same schedule. The headend has decorated
+    # titles, no descriptions and a clock that is off by offset - just like the real thing.
+    rng = random.Random(seed)
+    int_channels = {}
+    hd_channels = {}
+    int_programs = []
+    hd_programs = []
+    start = datetime(2020, 1, 1)
+    per_channel = max(n_programs // n_channels, 1)
+
+    for c in range(n_channels):
+        int_channels['ch{}.au'.format(c)] = channel(id='ch{}.au'.format(c), display_name='Channel {}'.format(c), lcn=str(c))
+        hd_channels[str(1000+c)] = channel(id=str(1000+c), display_name='Channel {}'.format(c), lcn=str(c))
+
+        t = start
+        for i in range(per_channel):
+            title = rng.choice(TITLES)
+            length = timedelta(minutes=rng.choice([30, 60, 90]))
+            int_programs.append(program(title=title, start=t, stop=t+length, channel='ch{}.au'.format(c),
+                                        sub_title='Episode {}'.format(i), tz='+1000',
+                                        description='{} episode {} on channel {}'.format(title, i, c)))
+            if rng.random() < 0.2:
+                title = 'New: {} (HD)'.format(title)
+            hd_programs.append(program(title=title, start=t-offset, stop=t+length-offset,
+                                       channel=str(1000+c), tz='+1000'))
+            t += length
+
+    internet_path = os.path.join(directory, 'internet.xml')
+    headend_path = os.path.join(directory, 'headend.xml')
+    xmltv.write_xml(int_programs, int_channels, internet_path)
+    xmltv.write_xml(hd_programs, hd_channels, headend_path)
+    return (internet_path, headend_path)
+
+def import_time(module='epg_tool', repeat=3):
+    # Best time for a fresh interpreter to import module
+    code = 'import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)'.format(module)
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True)
+        elapsed = float(out.stdout.decode().strip())
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(sizes, engine='window'):
+    results = []
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            internet_path, headend_path = generate_guides(directory, n)
+            result = {'programs': n}
+
+            tic = time.perf_counter()
+            internet_programs, internet_channels, internet_index = xmltv.parse_xml(internet_path)
+            tvhd_programs, tvhd_channels, _ = xmltv.parse_xml(headend_path)
+            result['parse'] = time.perf_counter() - tic
+
+            tic = time.perf_counter()
+            tvhd_channels, tvhd_programs = xmltv.transfer_channel_ids(tvhd_channels, tvhd_programs, internet_channels)
+            tvhd_programs, matches = xmltv.match_headend_to_internet(tvhd_programs, internet_programs,
+                                                                     internet_channels, internet_index,
+                                                                     engine=engine)
+            result['match'] = time.perf_counter() - tic
+            result['matched'] = len(matches)
+
+            tic = time.perf_counter()
+            xmltv.write_xml(tvhd_programs, tvhd_channels, os.path.join(directory, 'out.xml'))
+            result['write'] = time.perf_counter() - tic
+
+        results.append(result)
+    return results
+
+def print_report(import_times, results):
+    print('Import times')
+    for module, elapsed in import_times.items():
+        print('    {:<20} {:8.3f} s'.format(module, elapsed))
+
+    print('{:>10} {:>10} {:>10} {:>10} {:>10}'.format('programs', 'matched', 'parse s', 'match s', 'write s'))
+    for r in results:
+        print('{:>10} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}'.format(r['programs'], r['matched'],
+                                                                 r['parse'], r['match'], r['write']))
+
+class __rss_sampler:
+    # Keeps an eye on the resident set size from another thread, since the lxml tree lives
+    # outside of what tracemalloc can see
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = self.rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__sample, daemon=True)
+
+    @staticmethod
+    def rss():
+        # Linux only. None anywhere else.
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return None
+
+    def __sample(self):
+        while not self.stopped.wait(self.interval):
+            rss = self.rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def reset(self):
+        self.peak = self.rss()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+def __structure_bytes(snapshot):
+    # Live traced bytes by structure, going by the file each block was allocated from
+    by_structure = {name: 0 for name in STRUCTURES}
+    by_structure['other'] = 0
+    for stat in snapshot.statistics('filename'):
+        filename = os.path.basename(stat.traceback[0].filename)
+        for name, files in STRUCTURES.items():
+            if filename in files:
+                by_structure[name] += stat.size
+                break
+        else:
+            by_structure['other'] += stat.size
+    return by_structure
+
+def measure_memory(internet_path, headend_path, trace, engine='window'):
+    # Parse, match and write in this process and return what each stage took. With trace this
+    # is tracemalloc's view (exact, but only python objects), without it the resident set size.
+    # Both at once would count tracemalloc's own bookkeeping as ours.
+    gc.collect()
+    stages = {}
+    with __rss_sampler() as sampler:
+        baseline = sampler.rss()
+        if trace:
+            tracemalloc.start()
+
+        def stage(name, func):
+            sampler.reset()
+            if trace:
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                else:
+                    # No reset_peak before python 3.9. Starting over works too, but then each
+                    # stage only counts what it allocated itself.
+                    tracemalloc.stop()
+                    tracemalloc.start()
+            result = func()
+            stages[name] = {}
+            if trace:
+                snapshot = tracemalloc.take_snapshot()
+                stages[name]['traced_peak'] = tracemalloc.get_traced_memory()[1]
+                stages[name]['blocks'] = sum(stat.count for stat in snapshot.statistics('filename'))
+                stages[name]['structures'] = __structure_bytes(snapshot)
+                del snapshot
+            elif baseline is not None:
+                stages[name]['rss_peak'] = max(sampler.peak, sampler.rss()) - baseline
+            return result
+
+        internet_programs, internet_channels, internet_index = stage('parse', lambda: xmltv.parse_xml(internet_path))
+        tvhd_programs, tvhd_channels, _ = stage('parse headend', lambda: xmltv.parse_xml(headend_path))
+        tvhd_channels, tvhd_programs = xmltv.transfer_channel_ids(tvhd_channels, tvhd_programs, internet_channels)
+        tvhd_programs, _ = stage('match', lambda: xmltv.match_headend_to_internet(tvhd_programs, internet_programs,
+                                                                                  internet_channels, internet_index,
+                                                                                  engine=engine))
+        with tempfile.TemporaryDirectory() as directory:
+            stage('write', lambda: xmltv.write_xml(tvhd_programs, tvhd_channels, os.path.join(directory, 'out.xml')))
+
+        if trace:
+            tracemalloc.stop()
+
+    # Both guides get parsed, so parse is the two together
+    parse = stages.pop('parse headend')
+    for key in ['traced_peak', 'rss_peak']:
+        if key in parse:
+            stages['parse'][key] = max(stages['parse'][key], parse[key])
+    for key in ['blocks', 'structures']:
+        if key in parse:
+            stages['parse'][key] = parse[key]
+    return stages
+
+def run_memory(sizes, engine='window'):
+    # Every size is measured in fresh interpreters (one traced, one not) so earlier sizes and
+    # generating the guides don't leave memory lying around to be reused
+    results = []
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            internet_path, headend_path = generate_guides(directory, n)
+            result = {'programs': n, 'stages': {}}
+            for trace in [False, True]:
+                cmd = [sys.executable, '-m', 'epg_tool.benchmark', '--measure-memory', internet_path, headend_path,
+                       '--engine', engine]
+                if trace:
+                    cmd.append('--trace')
+                out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+                for name, values in json.loads(out.stdout.decode().strip().splitlines()[-1]).items():
+                    result['stages'].setdefault(name, {}).update(values)
+
+            for values in result['stages'].values():
+                # Whatever the process grew by that python didn't allocate is lxml (and the interpreter)
+                if 'rss_peak' in values:
+                    values['structures']['lxml and native'] = max(values['rss_peak'] - values['traced_peak'], 0)
+            # Both guides are n programs each
+            peak = max(v.get('rss_peak', v['traced_peak']) for v in result['stages'].values())
+            result['bytes_per_program'] = peak / (2 * n)
+        results.append(result)
+    return results
+
+def check_memory_budget(results, budget):
+    # The sizes that used more than budget bytes per program at their peak
+    return [r['programs'] for r in results if r['bytes_per_program'] > budget]
+
+def print_memory_report(results):
+    mb = 2**20
+    for r in results:
+        print('{} programs per guide - {:.0f} bytes per program at peak'.format(r['programs'], r['bytes_per_program']))
+        print('    {:<8} {:>10} {:>10} {:>10}  {}'.format('stage', 'rss MB', 'traced MB', 'blocks', 'live MB by structure'))
+        for name, values in r['stages'].items():
+            rss = '{:.1f}'.format(values['rss_peak'] / mb) if 'rss_peak' in values else 'n/a'
+            structures = ', '.join('{} {:.1f}'.format(k, v / mb) for k, v in values['structures'].items())
+            print('    {:<8} {:>10} {:>10.1f} {:>10}  {}'.format(name, rss, values['traced_peak'] / mb,
+                                                                values['blocks'], structures))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time parsing, matching and writing generated guides')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated program counts')
+    parser.add_argument('--engine', default='window', choices=['window', 'sequence'])
+    parser.add_argument('--memory', action='store_true', help='measure peak memory instead of time')
+    parser.add_argument('--budget', type=float, help='fail if any size peaks above this many bytes per program')
+    # What --memory runs for each size
+    parser.add_argument('--measure-memory', nargs=2, metavar=('INTERNET', 'HEADEND'), help=argparse.SUPPRESS)
+    parser.add_argument('--trace', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_memory:
+        print(json.dumps(measure_memory(args.measure_memory[0], args.measure_memory[1], args.trace,
+                                        engine=args.engine)))
+    elif args.memory:
+        results = run_memory([int(n) for n in args.sizes.split(',')], engine=args.engine)
+        print_memory_report(results)
+        if args.budget is not None:
+            over = check_memory_budget(results, args.budget)
+            if over:
+                print('Over the budget of {:.0f} bytes per program at sizes {}'.format(args.budget, over))
+                sys.exit(1)
+    else:
+        import_times = {}
+        for module in ['epg_tool', 'epg_tool.program', 'epg_tool.xmltv', 'epg_tool.enricher']:
+            import_times[module] = import_time(module)
+
+        print_report(import_times, run([int(n) for n in args.sizes.split(',')], engine=args.engine))
@@ -0,0 +1,96 @@
+import time
+import requests
+
+# Errors that are worth another go. Anything else is passed straight back to the caller.
+RETRYABLE = (requests.exceptions.ReadTimeout,
+             requests.exceptions.ConnectionError,
+             requests.exceptions.RetryError)
+
+def __is_retryable(e):
+    # tmdbsimple raises HTTPError for every bad status. Being rate limited or the server falling
+    # over is worth another go, anything else (a bad key, a missing id) won't get better.
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, RETRYABLE)
+
+class EnrichmentUnavailable(Exception):
+    pass
+
+class RunBudget:
+    def __init__(self, deadline=None, max_calls=None, failure_threshold=5, cooldown=300, throttle=None):
+        # deadline is in seconds from now, cooldown is how long a provider is left alone
+        # once it has failed failure_threshold times in a row. throttle(provider) is called
+        # before every request and can block to keep us under a rate limit.
+        if deadline is not None:
+            self.deadline = time.monotonic() + deadline
+        else:
+            self.deadline = None
+        self.max_calls = max_calls
+        self.throttle = throttle
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.calls = 0
+        self.failures = {}
+        self.open_until = {}
+
+    def time_left(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def acquire(self, provider):
+        # Call this before every request - it raises if we aren't allowed to make it
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise EnrichmentUnavailable('Run deadline reached')
+        if self.max_calls is not None and self.calls >= self.max_calls:
+            raise EnrichmentUnavailable('Used all {} api calls for this run'.format(self.max_calls))
+        if self.open_until.get(provider, 0) > time.monotonic():
+            raise EnrichmentUnavailable('{} is failing, leaving it alone for now'.format(provider))
+
+        if self.throttle is not None:
+            self.throttle(provider)
+        self.calls += 1
+
+    def record_success(self, provider):
+        self.failures[provider] = 0
+
+    def record_failure(self, provider):
+        self.failures[provider] = self.failures.get(provider, 0) + 1
+        if self.failures[provider] >= self.failure_threshold:
+            print('{} failed {} times in a row. Not calling it for {} seconds'.format(provider,
+                                                                                    self.failures[provider],
+                                                                                    self.cooldown))
+            self.open_until[provider] = time.monotonic() + self.cooldown
+            self.failures[provider] = 0
+
+def call_with_retries(provider, func, budget=None, retries=3, backoff=10):
+    # Run func, retrying a bounded number of times on network trouble. Once we are out of
+    # attempts the last exception is raised.
+    attempt = 0
+    while True:
+        if budget is not None:
+            budget.acquire(provider)
+
+        try:
+            result = func()
+        except requests.exceptions.RequestException as e:
+            if not __is_retryable(e):
+                raise
+            if budget is not None:
+                budget.record_failure(provider)
+
+            attempt += 1
+            if attempt > retries:
+                raise
+
+            # Back off a little more every time, but never sleep past the deadline
+            delay = backoff * 2**(attempt-1)
+            if budget is not None and budget.time_left() is not None:
+                delay = min(delay, budget.time_left())
+            print('Got hit with a retryable exception. Sleeping for {} seconds and going at it again: {}'.format(delay, e))
+            time.sleep(delay)
+            continue
+
+        if budget is not None:
+            budget.record_success(provider)
+        return result
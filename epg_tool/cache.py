@@ -0,0 +1,88 @@
+import os
+import stat
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # No fcntl on Windows - fall back to only locking between threads
+    fcntl = None
+
+# lockf locks belong to the whole process, so threads need their own lock on top
+__thread_locks = {}
+__thread_locks_lock = threading.Lock()
+
+# Filled in on first use by __get_umask
+__umask = []
+__umask_lock = threading.Lock()
+
+def __get_umask():
+    # Linux will tell us the umask without changing it. Anywhere else it can only be read by
+    # setting it, which races any other thread creating files, so that is only done the once.
+    with __umask_lock:
+        if not __umask:
+            try:
+                with open('/proc/self/status') as f:
+                    __umask.extend(int(line.split()[1], 8) for line in f if line.startswith('Umask:'))
+            except OSError:
+                pass
+            if not __umask:
+                mask = os.umask(0o022)
+                os.umask(mask)
+                __umask.append(mask)
+        return __umask[0]
+
+def __file_mode(path):
+    # Keep the mode of the file we are replacing, otherwise whatever the umask allows
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~__get_umask()
+
+def atomic_write(path, data, mode='w'):
+    # Write to a temporary file next to path and rename it over the top. Anyone reading path
+    # sees the old file or the new one, never half of one.
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            # mkstemp makes the file owner-only. Give it what a plain open() would so other
+            # users and hosts sharing the directory can still read it.
+            if hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), __file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextlib.contextmanager
+def locked(path):
+    # Hold an exclusive lock on path (through path.lock) across threads and processes. lockf
+    # locks also work across hosts when the shared filesystem supports them (NFS does).
+    path = os.path.abspath(path)
+    with __thread_locks_lock:
+        thread_lock = __thread_locks.setdefault(path, threading.Lock())
+
+    with thread_lock:
+        with open(path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+def merge_write(path, read, merge):
+    # Other jobs (and hosts) may share the directory and have written path since we loaded it,
+    # so never just overwrite it. Under the lock, read(path) loads what is there now (None if
+    # nothing is), merge(on_disk) combines it with ours and returns what to write.
+    with locked(path):
+        on_disk = read(path) if os.path.isfile(path) else None
+        atomic_write(path, merge(on_disk))
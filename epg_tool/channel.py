@@ -1,5 +1,3 @@
-from lxml import etree
-
 class channel:
 
     def __init__(self, id=None, display_name=None, lcn=None, icon=None):
@@ -24,6 +22,9 @@ class channel:
             self.icon = channel.find('icon').attrib['src']
 
     def to_xml(self):
+        # Only writing needs lxml
+        from lxml import etree
+
         channel = etree.Element('channel', id=self.id)
 
         if self.display_name is not None:
@@ -0,0 +1,79 @@
+import os
+import sys
+
+# What all of the scripts read from the environment, and the enrichers they build from it
+
+def require_env(*names):
+    # If the environment variables aren't set let's cancel
+    if not all(os.getenv(name) for name in names):
+        print('Not all environment variables set properly')
+        sys.exit(2)
+
+def cache_options():
+    # Keyword arguments for the enrichers' cache. CACHE_MAX_MB keeps each cache directory under
+    # that size by dropping the least recently (CACHE_EVICTION=lru) or least often (lfu) used
+    # results first. CACHE_COMPRESS=1 gzips them.
+    return {'max_bytes': int(float(os.getenv('CACHE_MAX_MB')) * 2**20) if os.getenv('CACHE_MAX_MB') else None,
+            'eviction': os.getenv('CACHE_EVICTION', 'lru'),
+            'compress': os.getenv('CACHE_COMPRESS', '') == '1'}
+
+def read_skip_patterns(location):
+    # Titles that are never worth looking up - one regular expression per line
+    if not os.path.isfile(location):
+        return []
+    with open(location) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def read_settings(make_dirs=True):
+    # Everything under DATA_VOLUME, plus how hard to push the apis
+    data_vol = os.getenv('DATA_VOLUME')
+    settings = {
+        'data_vol': data_vol,
+        'movie_cachedir': os.path.join(data_vol, 'tv_cache', 'tmdb'),
+        'tv_cachedir': os.path.join(data_vol, 'tv_cache', 'tvmaze'),
+        'snapshot_dir': os.path.join(data_vol, 'snapshots'),
+        'skip_patterns': read_skip_patterns(os.path.join(data_vol, 'skip_titles.txt')),
+        # Stop hitting the apis after this long so a dead provider can't stall the run
+        'deadline': float(os.getenv('ENRICH_DEADLINE_MINUTES', '120')) * 60,
+        'max_calls': int(os.getenv('ENRICH_MAX_CALLS')) if os.getenv('ENRICH_MAX_CALLS') else None,
+        # Set this to share the enrichment with run_enrichment_worker on other machines
+        'broker_location': os.getenv('ENRICH_BROKER'),
+        'cache': cache_options(),
+    }
+    # Make sure we have the directories we need to do the job
+    if make_dirs:
+        for directory in [settings['movie_cachedir'], settings['tv_cachedir'], settings['snapshot_dir']]:
+            os.makedirs(directory, exist_ok=True)
+    return settings
+
+def make_broker(settings, default=None):
+    # The broker from ENRICH_BROKER, otherwise one at default, otherwise none at all
+    from epg_tool.workqueue import SQLiteBroker
+
+    location = settings['broker_location'] or default
+    return SQLiteBroker(location) if location else None
+
+def make_enrichers(settings, broker=None, limited=True):
+    # (movie enricher, tv enricher) sharing one budget. limited holds them to the run deadline
+    # and call cap. With a broker the rate limits are shared with all of the workers.
+    import tmdbsimple as tmdb
+    from epg_tool.budget import RunBudget
+    from epg_tool.enricher import TMDBEnricher, TvMazeEnricher
+    from epg_tool.workqueue import broker_throttle
+
+    tmdb.API_KEY = os.getenv('MOVIEDB_KEY')
+    budget = RunBudget(deadline=settings['deadline'] if limited else None,
+                       max_calls=settings['max_calls'] if limited else None,
+                       throttle=broker_throttle(broker) if broker else None)
+    movie_enricher = TMDBEnricher(settings['movie_cachedir'], skip_patterns=settings['skip_patterns'],
+                                  budget=budget, **settings['cache'])
+    tv_enricher = TvMazeEnricher(settings['tv_cachedir'], skip_patterns=settings['skip_patterns'],
+                                 budget=budget, **settings['cache'])
+    return (movie_enricher, tv_enricher)
+
+def flush_caches(*enrichers):
+    # Write out everything the enrichers learned this run
+    for enricher in enrichers:
+        enricher.write_series_csv()
+        enricher.write_negative_cache()
+        enricher.write_cache_index()
@@ -0,0 +1,80 @@
+import os
+import json
+import socket
+import hashlib
+from epg_tool.cache import atomic_write
+from epg_tool.xmltv import open_xml_stream, write_xml
+
+def program_key(program):
+    return '{}|{}'.format(program.channel, program.start.strftime('%Y%m%d%H%M%S'))
+
+# Everything program.to_xml writes out, besides the flags
+HASHED_FIELDS = ['title', 'start', 'stop', 'tz', 'channel', 'sub_title', 'description', 'date', 'categories',
+                 'icon', 'episode_num', 'airdate', 'ratings']
+
+def program_hash(program):
+    # Anything that would change what ends up in the guide changes this. Hashing the fields
+    # saves serializing every program a second time just to compare it.
+    fields = [getattr(program, name) for name in HASHED_FIELDS]
+    fields += [bool(program.previously_shown), bool(program.premiere)]
+    return hashlib.sha1(json.dumps(fields, default=str).encode('utf-8')).hexdigest()
+
+def push_xmltv(programs, channels, socket_path):
+    # Hand programs to tvheadend's external XMLTV grabber, which imports whatever is written to
+    # its unix socket (epggrab/xmltv.sock) and leaves the rest of the guide alone
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('wb') as sock_file:
+            with open_xml_stream(sock_file, channels) as write_program:
+                for p in programs:
+                    write_program(p)
+
+class GuideDelta:
+    # What changed since the guide was last published. The state next to the guide maps
+    # (channel, start) to a hash of the program, so the programs that are new or different
+    # are the only ones that need pushing. Feed it every program as it is written.
+    def __init__(self, state_location):
+        self.state_location = state_location
+        self.previous = {}
+        if os.path.isfile(state_location):
+            with open(state_location) as f:
+                self.previous = json.load(f)
+        self.state = {}
+        self.changed = []
+
+    def add(self, program):
+        key = program_key(program)
+        self.state[key] = program_hash(program)
+        if self.previous.get(key) != self.state[key]:
+            self.changed.append(program)
+
+    def removed(self):
+        # Mostly what has already aired. tvheadend expires those itself.
+        return len(set(self.previous.keys()) - set(self.state.keys()))
+
+    def save(self):
+        atomic_write(self.state_location, json.dumps(self.state, separators=(',', ':')))
+
+    def publish(self, channels, socket_path=None):
+        # Push the changes to tvheadend and remember what it now has. If the push fails the state
+        # is left alone so the same changes go out next time - the full file is still there.
+        report = {'programs': len(self.state), 'changed': len(self.changed), 'removed': self.removed(),
+                  'pushed': False}
+        if socket_path is not None and self.changed:
+            try:
+                push_xmltv(self.changed, channels, socket_path)
+            except OSError as e:
+                print('Could not push the changes to {}: {}'.format(socket_path, e))
+                return report
+            report['pushed'] = True
+        self.save()
+        return report
+
+def write_xml_delta(programs, channels, location, socket_path=None):
+    # write_xml, plus pushing just the changed programs to tvheadend's socket
+    delta = GuideDelta(location + '.state')
+    write_xml(programs, channels, location + '.tmp')
+    os.replace(location + '.tmp', location)
+    for p in programs:
+        delta.add(p)
+    return delta.publish(channels, socket_path)
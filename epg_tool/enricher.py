@@ -1,20 +1,57 @@
 import os
+import re
+import gzip
 import json
 import time
 import datetime
+import requests
 import pandas as pd
 import tmdbsimple as tmdb
 import epg_tool.tvmaze as tvm
+from epg_tool.budget import EnrichmentUnavailable, call_with_retries
+from epg_tool.normalize import normalize_title, normalize_text
+from epg_tool.cache import atomic_write, merge_write
 
 from fuzzywuzzy import process, fuzz
 
+# Everything enrichment might change on a program
+ENRICHED_FIELDS = ['title', 'sub_title', 'description', 'categories', 'episode_num', 'airdate', 'date']
+
+# How long a failed lookup is remembered. Every repeated miss doubles this, up to the max
+NEGATIVE_CACHE_BASE = datetime.timedelta(days=1)
+NEGATIVE_CACHE_MAX = datetime.timedelta(days=30)
+
+# Files in the cache directory that are bookkeeping rather than cached api results
+CACHE_BOOKKEEPING = ['negative_cache.json', 'cache_index.json']
+
 class GenericEnricher:
-    def __init__(self, cachedir):
+    def __init__(self, cachedir, skip_patterns=None, budget=None, max_bytes=None, eviction='lru', compress=False):
+        # max_bytes caps the cached api results. Once over it the least recently ('lru') or least
+        # often ('lfu') used ones are dropped. compress gzips everything we write from now on.
         self.cachedir = cachedir
+        self.budget = budget
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.compress = compress
         self.pulled_series = []
         self.pulled_episodes = []
         self.update_written = False
 
+        # Cache file -> {'last_access': seconds, 'hits': int} since cache_index.json was last written
+        self.cache_access = {}
+
+        # Titles matching any of these are never looked up (news, sport, infomercials...)
+        self.skip_patterns = []
+        if skip_patterns:
+            for pattern in skip_patterns:
+                self.skip_patterns.append(re.compile(pattern, re.IGNORECASE))
+
+        # Lookups that found nothing last time. key -> {'expires': str, 'misses': int}
+        self.negative_cache = {}
+        if os.path.isfile(os.path.join(self.cachedir, 'negative_cache.json')):
+            with open(os.path.join(self.cachedir, 'negative_cache.json')) as f:
+                self.negative_cache = json.load(f)
+
         # Get the show_dataframe all ready to go
         if os.path.isfile(os.path.join(self.cachedir, 'show_dataframe.csv')):
             self.series_df = pd.read_csv(os.path.join(self.cachedir, 'show_dataframe.csv'))
@@ -28,30 +65,109 @@ class GenericEnricher:
         else:
             self.last_update = None
 
+    @staticmethod
+    def __read_json(path):
+        with open(path) as f:
+            return json.load(f)
+
     def __write_update(self):
         self.update_written = True
-        with open(os.path.join(self.cachedir, 'last_update.txt'), 'w') as f:
-            cur_time = datetime.datetime.now()
-            # We don't care about fractional seconds
-            cur_time = cur_time - datetime.timedelta(microseconds=cur_time.microsecond)
-            f.write(str(cur_time))
+        cur_time = datetime.datetime.now()
+        # We don't care about fractional seconds
+        cur_time = cur_time - datetime.timedelta(microseconds=cur_time.microsecond)
+        atomic_write(os.path.join(self.cachedir, 'last_update.txt'), str(cur_time))
+
+    def request(self, provider, func):
+        # Every api call goes through here so it counts against the run budget
+        return call_with_retries(provider, func, budget=self.budget)
+
+    def __negative_key(self, program, kind):
+        return '{}|{}|{}|{}'.format(kind, normalize_title(program.title) or '', program.channel or '', 
+                                    program.imdb_id or '')
+
+    def should_skip(self, program, kind):
+        # True if we already know this lookup won't find anything
+        if program.title:
+            for pattern in self.skip_patterns:
+                if pattern.search(program.title):
+                    return True
+
+        entry = self.negative_cache.get(self.__negative_key(program, kind))
+        if entry is None:
+            return False
+
+        expires = datetime.datetime.strptime(entry['expires'], '%Y-%m-%d %H:%M:%S')
+        return datetime.datetime.now() < expires
+
+    def record_miss(self, program, kind):
+        key = self.__negative_key(program, kind)
+        misses = 1
+        if key in self.negative_cache:
+            misses = self.negative_cache[key]['misses'] + 1
+
+        # Back off - the more often we miss, the longer we wait before trying again
+        delay = min(NEGATIVE_CACHE_BASE * 2**(misses-1), NEGATIVE_CACHE_MAX)
+        expires = datetime.datetime.now() + delay
+        expires = expires - datetime.timedelta(microseconds=expires.microsecond)
+        self.negative_cache[key] = {'expires': str(expires), 'misses': misses}
+
+    def write_negative_cache(self):
+        # Drop the entries that have expired so the file doesn't just keep growing
+        now = datetime.datetime.now()
+        for key in list(self.negative_cache.keys()):
+            expires = datetime.datetime.strptime(self.negative_cache[key]['expires'], '%Y-%m-%d %H:%M:%S')
+            # Keep the miss count around for a while so the backoff still works
+            if now - expires > NEGATIVE_CACHE_MAX:
+                del self.negative_cache[key]
+
+        def merge(on_disk):
+            # Whoever has missed more often knows better
+            for key, entry in (on_disk or {}).items():
+                if key not in self.negative_cache or entry['misses'] > self.negative_cache[key]['misses']:
+                    self.negative_cache[key] = entry
+            return json.dumps(self.negative_cache, separators=(',', ':'))
+        merge_write(os.path.join(self.cachedir, 'negative_cache.json'), self.__read_json, merge)
 
     def embed_stubbed_episode_info(self, program):
         if not program.episode_num:
             program.episode_num = '{}.{}{}{}'.format(program.start.year-1, program.start.month, program.start.day, program.start.minute-1)
         return program
 
+    def __record_access(self, filepath):
+        name = os.path.basename(filepath)
+        entry = self.cache_access.setdefault(name, {'last_access': 0, 'hits': 0})
+        entry['last_access'] = time.time()
+        entry['hits'] += 1
+
     def get_info_generic(self, filepath):
-        if os.path.isfile(filepath):
-            with open(filepath) as json_file:
-                return json.load(json_file)
+        # Compressed or not, whichever is there. Maintenance may delete it out from under us.
+        for path, opener in ((filepath + '.gz', gzip.open), (filepath, open)):
+            try:
+                with opener(path, 'rt') as json_file:
+                    data = json.load(json_file)
+            except FileNotFoundError:
+                continue
+            self.__record_access(filepath)
+            return data
+        return None
+
+    def __write_cached(self, filepath, data):
+        # Compact json - nobody reads these by hand - gzipped if asked. Whichever encoding
+        # we aren't using any more goes.
+        encoded = json.dumps(data, separators=(',', ':'))
+        if self.compress:
+            atomic_write(filepath + '.gz', gzip.compress(encoded.encode('utf-8')), mode='wb')
+            stale = filepath
         else:
-            return None
+            atomic_write(filepath, encoded)
+            stale = filepath + '.gz'
+        if os.path.isfile(stale):
+            os.remove(stale)
 
     def save_info_generic(self, filepath, data):
         # Save it
-        with open(filepath, 'w') as json_file:
-            json.dump(data, json_file, indent=4)
+        self.__write_cached(filepath, data)
+        self.__record_access(filepath)
         
         # Point out we have done some updates
         if not self.update_written:
@@ -138,17 +254,129 @@ class GenericEnricher:
         return None
 
     def write_series_csv(self):
-        filepath = os.path.join(self.cachedir, 'show_dataframe.csv')
-        self.series_df.to_csv(filepath, index=False)
+        def merge(on_disk):
+            if on_disk is not None:
+                merged = pd.concat([on_disk, self.series_df], ignore_index=True, sort=False)
+                # Compare as text - ids come back from the csv as numbers and missing ones as NaN
+                self.series_df = merged[~merged.fillna('').astype(str).duplicated()].reset_index(drop=True)
+            return self.series_df.to_csv(index=False)
+        merge_write(os.path.join(self.cachedir, 'show_dataframe.csv'), pd.read_csv, merge)
+
+    def __cached_files(self):
+        # Logical cache file name -> (path on disk, size in bytes)
+        files = {}
+        for filename in os.listdir(self.cachedir):
+            name = filename[:-3] if filename.endswith('.gz') else filename
+            if name.endswith('.json') and name not in CACHE_BOOKKEEPING and not filename.startswith('.'):
+                path = os.path.join(self.cachedir, filename)
+                files[name] = (path, os.path.getsize(path))
+        return files
+
+    def __evict(self, index):
+        # Drop cached results until we are back under max_bytes. Anything the index doesn't know
+        # about yet falls back on its modification time.
+        files = self.__cached_files()
+        total = sum(size for _, size in files.values())
+        for name in list(index.keys()):
+            if name not in files:
+                del index[name]
+        if self.max_bytes is None or total <= self.max_bytes:
+            return []
+
+        def usage(name):
+            entry = index.get(name, {'last_access': os.path.getmtime(files[name][0]), 'hits': 0})
+            if self.eviction == 'lfu':
+                return (entry['hits'], entry['last_access'])
+            return (entry['last_access'], entry['hits'])
+
+        evicted = []
+        for name in sorted(files.keys(), key=usage):
+            if total <= self.max_bytes:
+                break
+            path, size = files[name]
+            os.remove(path)
+            index.pop(name, None)
+            total -= size
+            evicted.append(name)
+        return evicted
+
+    def write_cache_index(self):
+        # Record what we used this run and, with a max_bytes, evict whatever is over it
+        evicted = []
+        def merge(on_disk):
+            index = on_disk or {}
+            for name, access in self.cache_access.items():
+                entry = index.setdefault(name, {'last_access': 0, 'hits': 0})
+                entry['last_access'] = max(entry['last_access'], access['last_access'])
+                entry['hits'] += access['hits']
+            self.cache_access = {}
+
+            evicted.extend(self.__evict(index))
+            return json.dumps(index, separators=(',', ':'))
+        merge_write(os.path.join(self.cachedir, 'cache_index.json'), self.__read_json, merge)
+        if evicted:
+            print('Evicted {} files to keep the cache under {} bytes'.format(len(evicted), self.max_bytes))
+        return evicted
+
+    def __load_all(self):
+        # How long it takes to read everything in the cache - roughly what a cold run pays
+        tic = time.perf_counter()
+        for name in self.__cached_files():
+            self.get_info_generic(os.path.join(self.cachedir, name))
+        if os.path.isfile(os.path.join(self.cachedir, 'show_dataframe.csv')):
+            pd.read_csv(os.path.join(self.cachedir, 'show_dataframe.csv'))
+        return time.perf_counter() - tic
+
+    def __cache_bytes(self):
+        total = 0
+        for filename in os.listdir(self.cachedir):
+            if os.path.isfile(os.path.join(self.cachedir, filename)):
+                total += os.path.getsize(os.path.join(self.cachedir, filename))
+        return total
+
+    def maintain_cache(self):
+        # Rewrite everything in the current encoding, drop duplicate series rows and evict down to
+        # max_bytes. Returns what that bought us.
+        bytes_before = self.__cache_bytes()
+        # Loading everything to time it isn't real use, so it doesn't count as access
+        pending = self.cache_access
+        load_before = self.__load_all()
+        self.cache_access = pending
+
+        rewritten = 0
+        for name, (path, _) in self.__cached_files().items():
+            with (gzip.open if path.endswith('.gz') else open)(path, 'rt') as f:
+                raw = f.read()
+            data = json.loads(raw)
+            # Only rewrite what is in the old (indented or differently compressed) encoding
+            if path.endswith('.gz') != self.compress or raw != json.dumps(data, separators=(',', ':')):
+                self.__write_cached(os.path.join(self.cachedir, name), data)
+                rewritten += 1
+
+        series_rows = len(self.series_df)
+        if os.path.isfile(os.path.join(self.cachedir, 'show_dataframe.csv')):
+            series_rows = len(pd.read_csv(os.path.join(self.cachedir, 'show_dataframe.csv')))
+        self.write_series_csv()
+        self.write_negative_cache()
+        evicted = self.write_cache_index()
+
+        bytes_after = self.__cache_bytes()
+        load_after = self.__load_all()
+        self.cache_access = {}
+        return {'bytes_before': bytes_before, 'bytes_after': bytes_after, 'reclaimed': bytes_before - bytes_after,
+                'rewritten': rewritten, 'evicted': len(evicted), 
+                'duplicate_series_rows': series_rows - len(self.series_df),
+                'load_seconds_before': load_before, 'load_seconds_after': load_after}
 
 class TMDBEnricher(GenericEnricher):
-    def __init__(self, cachedir):
-        super().__init__(cachedir)
+    def __init__(self, cachedir, skip_patterns=None, budget=None, max_bytes=None, eviction='lru', compress=False):
+        super().__init__(cachedir, skip_patterns=skip_patterns, budget=budget, max_bytes=max_bytes,
+                         eviction=eviction, compress=compress)
 
     def get_series_info(self, tmdb_id, force_update=False):
         # In this case we are just going to get new series info
         if force_update and tmdb_id not in self.pulled_series:
-            result = tmdb.TV(tmdb_id).info()
+            result = self.request('tmdb', lambda: tmdb.TV(tmdb_id).info())
             
             if not result:
                 return None
@@ -177,7 +405,7 @@ class TMDBEnricher(GenericEnricher):
                 return None
 
             for season in series_info['seasons']:
-                result = tmdb.TV_Seasons(tmdb_id, season['season_number']).info()
+                result = self.request('tmdb', lambda: tmdb.TV_Seasons(tmdb_id, season['season_number']).info())
                 episodes += (result['episodes'])
 
             if not episodes:
@@ -196,7 +424,7 @@ class TMDBEnricher(GenericEnricher):
                 return result
 
     def __get_movie_info(self, tmdb_id):
-        result = tmdb.Movies(tmdb_id).info()
+        result = self.request('tmdb', lambda: tmdb.Movies(tmdb_id).info())
         return result
 
     def get_series_id(self, program):
@@ -205,10 +433,14 @@ class TMDBEnricher(GenericEnricher):
 
         if result:
             return result
+
+        # Don't bother the api with things we know it doesn't have
+        if self.should_skip(program, 'series'):
+            return None
         
         # Prefer searching by the imdb_id - that will ultimately give the best results
         if program.imdb_id:
-            result = tmdb.Find(program.imdb_id).info(external_source="imdb_id")
+            result = self.request('tmdb', lambda: tmdb.Find(program.imdb_id).info(external_source="imdb_id"))
             # First look for the TV show
             if result['tv_results']:
                 return result['tv_results'][0]['id']
@@ -217,7 +449,7 @@ class TMDBEnricher(GenericEnricher):
                 return None
 
         # In this case we haven't seen it before, so let's search tmdb - doing a series search
-        result = tmdb.Search().tv(query=program.title, include_adult=False)
+        result = self.request('tmdb', lambda: tmdb.Search().tv(query=program.title, include_adult=False))
 
         if result['results']:
             new_row = dict(series_name=program.title, channel_id=program.channel, \
@@ -226,22 +458,27 @@ class TMDBEnricher(GenericEnricher):
             self.series_df = self.series_df.append(to_app, ignore_index=True, sort=False)
             return result['results'][0]['id']
 
-        # We didn't find a single thing! return None
+        # We didn't find a single thing! Remember that and return None
+        self.record_miss(program, 'series')
         return None
 
     def get_movie_id(self, program):
+        if self.should_skip(program, 'movie'):
+            return None
+
         if program.imdb_id:
-            result = tmdb.Find(program.imdb_id).info(external_source="imdb_id")
+            result = self.request('tmdb', lambda: tmdb.Find(program.imdb_id).info(external_source="imdb_id"))
 
             if result['movie_results']:
                 return result['movie_results'][0]['id']
 
         # We need to search for this one
-        result = tmdb.Search().movie(query=program.title, include_adult=False)
+        result = self.request('tmdb', lambda: tmdb.Search().movie(query=program.title, include_adult=False))
         
         if result['results']:
             return result['results'][0]['id']
 
+        self.record_miss(program, 'movie')
         return None
 
     def __enrich_episode(self, program, ep_info):
@@ -340,13 +577,14 @@ class TMDBEnricher(GenericEnricher):
         return (program, True)
 
 class TvMazeEnricher(GenericEnricher):
-    def __init__(self, cachedir):
-        super().__init__(cachedir)
+    def __init__(self, cachedir, skip_patterns=None, budget=None, max_bytes=None, eviction='lru', compress=False):
+        super().__init__(cachedir, skip_patterns=skip_patterns, budget=budget, max_bytes=max_bytes,
+                         eviction=eviction, compress=compress)
     
     def get_series_info(self, tvmaze_id, force_update=False):
         # In this case we are just going to get new series info
         if force_update and tvmaze_id not in self.pulled_series:
-            result = tvm.get_show_info(tvmaze_id)
+            result = tvm.get_show_info(tvmaze_id, budget=self.budget)
             
             if result is None:
                 return None
@@ -366,7 +604,7 @@ class TvMazeEnricher(GenericEnricher):
     def get_episode_info(self, tvmaze_id, force_update=False):
         # In this case we are just going to get new series info
         if force_update and tvmaze_id not in self.pulled_episodes:
-            episodes = tvm.get_episode_info(tvmaze_id)
+            episodes = tvm.get_episode_info(tvmaze_id, budget=self.budget)
 
             if not episodes:
                 return None
@@ -389,15 +627,19 @@ class TvMazeEnricher(GenericEnricher):
 
         if result:
             return result
+
+        # Don't bother the api with things we know it doesn't have
+        if self.should_skip(program, 'series'):
+            return None
         
         # Prefer searching by the imdb_id - that will ultimately give the best results
         if program.imdb_id:
-            result = tvm.get_show_by_imdbid(program.imdb_id)
+            result = tvm.get_show_by_imdbid(program.imdb_id, budget=self.budget)
             if result:
                 return result['id']
 
         # In this case we haven't seen it before, so let's search tmdb - doing a series search
-        result = tvm.search_for_show(program.title)
+        result = tvm.search_for_show(program.title, budget=self.budget)
         if result:
             # This actually returns exactly what get_series_info would return as well!
             self.pulled_series.append(result['id'])
@@ -409,7 +651,8 @@ class TvMazeEnricher(GenericEnricher):
             self.series_df = self.series_df.append(to_app, ignore_index=True, sort=False)
             return result['id']
 
-        # We didn't find a single thing! return None
+        # We didn't find a single thing! Remember that and return None
+        self.record_miss(program, 'series')
         return None
 
     def __enrich_episode(self, program, ep_info):
@@ -479,3 +722,91 @@ class TvMazeEnricher(GenericEnricher):
 
         # We tried our best now just return what we have :)
         return (program, success)
+
+class EnrichmentMemo:
+    # Remembers how each program came out of enrichment for the rest of the run. Repeats,
+    # simulcasts and regional variants of the same thing then only cost a dictionary lookup.
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, program):
+        # Take this before enriching - enriching changes all of these
+        return (program.is_movie(), normalize_title(program.title), normalize_text(program.sub_title), 
+                normalize_text(program.description))
+
+    def lookup(self, key, program):
+        # Copies the remembered result onto program and returns whether it was a success,
+        # or None if we haven't seen it yet
+        if key not in self.results:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        fields, success = self.results[key]
+        for name, value in fields.items():
+            setattr(program, name, list(value) if isinstance(value, list) else value)
+        return success
+
+    def store(self, key, program, success):
+        fields = {name: getattr(program, name) for name in ENRICHED_FIELDS}
+        if not success and not key[0]:
+            # A stubbed episode number depends on when it airs so that has to be worked out each time
+            del fields['episode_num']
+        self.results[key] = (fields, success)
+
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0
+        return self.hits / (self.hits + self.misses)
+
+def enrich_programs(programs, movie_enricher, tv_enricher, memo=None, progress=True):
+    # Enrich everything we can. When the apis are down or we run out of budget the
+    # program is written out as is - a guide without enrichment beats no guide at all.
+    # Pass the same memo in for the whole run so repeats are only enriched once.
+    # progress prints how far along we are, or can be a function called before each program.
+    if memo is None:
+        memo = EnrichmentMemo()
+
+    report = {'successes': 0, 'skipped': 0, 'skip_reasons': {}, 'memo_hits': 0}
+    progs_to_write = []
+    for idx in range(len(programs)):
+        if callable(progress):
+            progress()
+        elif progress and idx % 100 == 0:
+            print('Finished enriching {} of {} programs'.format(idx, len(programs)))
+
+        p = programs[idx]
+        key = memo.key(p)
+        success = memo.lookup(key, p)
+        if success is not None:
+            if not success and not key[0]:
+                p = tv_enricher.embed_stubbed_episode_info(p)
+            progs_to_write.append(p)
+            report['memo_hits'] += 1
+            if success:
+                report['successes'] += 1
+            continue
+
+        try:
+            if p.is_movie():
+                ret_prog, success = movie_enricher.update_movie_program(p)
+            else:
+                ret_prog, success = tv_enricher.update_series_program(p)
+                ret_prog = tv_enricher.embed_stubbed_episode_info(ret_prog)  # to ensure it exists
+            memo.store(key, ret_prog, success)
+        except (EnrichmentUnavailable, requests.exceptions.RequestException) as e:
+            ret_prog, success = p, False
+            if not p.is_movie():
+                ret_prog = tv_enricher.embed_stubbed_episode_info(ret_prog)
+
+            report['skipped'] += 1
+            reason = str(e) if isinstance(e, EnrichmentUnavailable) else type(e).__name__
+            report['skip_reasons'][reason] = report['skip_reasons'].get(reason, 0) + 1
+
+        progs_to_write.append(ret_prog)
+        if success:
+            report['successes'] += 1
+
+    return (progs_to_write, report)
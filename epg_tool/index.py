@@ -0,0 +1,107 @@
+import bisect
+from datetime import datetime, timedelta
+from epg_tool.normalize import normalize_title, normalize_text
+
+EPOCH = datetime(1970, 1, 1)
+
+COLUMNS = ['start', 'stop', 'channel', 'title', 'sub_title', 'description', 'episode',
+           'array_index', 'norm_title', 'norm_description']
+
+def to_seconds(dt):
+    # Guide times are naive, so are these
+    return int((dt - EPOCH).total_seconds())
+
+def from_seconds(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+class guide_index:
+    # A column store of the programs in a guide, sorted by channel and then start time.
+    # start and stop are whole seconds since EPOCH, array_index points back into the
+    # program list the guide was parsed into.
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.__exact = None
+
+        # channel -> (first row, last row + 1)
+        self.channels = {}
+        channel_col = self.columns['channel']
+        first = 0
+        for row in range(1, len(channel_col) + 1):
+            if row == len(channel_col) or channel_col[row] != channel_col[first]:
+                self.channels[channel_col[first]] = (first, row)
+                first = row
+
+    @classmethod
+    def from_programs(cls, programs):
+        order = sorted(range(len(programs)), key=lambda i: (programs[i].channel, programs[i].start))
+
+        columns = {name: [] for name in COLUMNS}
+        for i in order:
+            p = programs[i]
+            columns['start'].append(to_seconds(p.start))
+            columns['stop'].append(to_seconds(p.stop))
+            columns['channel'].append(p.channel)
+            columns['title'].append(p.title)
+            columns['sub_title'].append(p.sub_title)
+            columns['description'].append(p.description)
+            columns['episode'].append(p.episode_num)
+            columns['array_index'].append(i)
+            # Normalize once here so matching never has to
+            columns['norm_title'].append(normalize_title(p.title))
+            columns['norm_description'].append(normalize_text(p.description))
+
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def rows(self, channel, start=None, stop=None):
+        # Rows on channel starting between start and stop (inclusive, in seconds)
+        if channel not in self.channels:
+            return range(0)
+
+        first, last = self.channels[channel]
+        starts = self.columns['start']
+        if start is not None:
+            first = bisect.bisect_left(starts, start, first, last)
+        if stop is not None:
+            last = bisect.bisect_right(starts, stop, first, last)
+        return range(first, last)
+
+    def exact_titles(self):
+        # (channel, normalized title) -> ([starts], [array indexes]) so exact matches are a dictionary
+        # lookup. Rows are sorted by start within a channel so these are too. Built once, on first use,
+        # and only handed out once it is finished since several matchers may share this index.
+        if self.__exact is None:
+            exact = {}
+            for ch, title, start, idx in zip(self.columns['channel'], self.columns['norm_title'], 
+                                             self.columns['start'], self.columns['array_index']):
+                if title:
+                    if (ch, title) not in exact:
+                        exact[(ch, title)] = ([], [])
+                    exact[(ch, title)][0].append(start)
+                    exact[(ch, title)][1].append(idx)
+            self.__exact = exact
+        return self.__exact
+
+    def to_dataframe(self):
+        # The old pandas layout, indexed by start time, for anyone who still wants it
+        import pandas as pd
+
+        data = {'Start_Time': [from_seconds(s) for s in self.columns['start']],
+                'Stop_Time': [from_seconds(s) for s in self.columns['stop']],
+                'Title': list(self.columns['title']),
+                'Subtitle': list(self.columns['sub_title']),
+                'Channel': list(self.columns['channel']),
+                'Description': list(self.columns['description']),
+                'Episode': list(self.columns['episode']),
+                'Array_Index': list(self.columns['array_index']),
+                'Norm_Title': list(self.columns['norm_title']),
+                'Norm_Description': list(self.columns['norm_description'])}
+        df = pd.DataFrame(data, index=data['Start_Time'])
+        df.sort_index(inplace=True)
+        return df
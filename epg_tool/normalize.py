@@ -0,0 +1,27 @@
+import re
+
+# EIT data likes to decorate titles - "New: Foo", "Movie: Foo", "Foo (HD)" and so on
+TITLE_PREFIX = re.compile(r'^(movie|new|premiere|season premiere|series premiere|final|live|return)\s*:\s*')
+TITLE_SUFFIX = re.compile(r'\s*[\(\[](hd|sd|r|rpt|repeat|new|live|cc|s|ad)[\)\]]$')
+PUNCTUATION = re.compile(r'[^\w\s]')
+
+def normalize_text(text):
+    # Lower case, no punctuation and single spaces
+    if text is None:
+        return None
+    text = PUNCTUATION.sub(' ', text.lower().replace('&', ' and '))
+    return ' '.join(text.split())
+
+def normalize_title(title):
+    if title is None:
+        return None
+
+    # Keep going until nothing changes - titles like "New: Movie: Foo (HD) (R)" do show up
+    title = title.lower().strip()
+    previous = None
+    while previous != title:
+        previous = title
+        title = TITLE_PREFIX.sub('', title)
+        title = TITLE_SUFFIX.sub('', title).strip()
+
+    return normalize_text(title)
@@ -0,0 +1,126 @@
+import os
+import queue
+import itertools
+import threading
+from epg_tool.xmltv import match_headend_to_internet, open_xml_stream
+from epg_tool.enricher import enrich_programs, EnrichmentMemo
+
+# Marks the end of the work on a queue
+DONE = object()
+
+def __split_by_channel(programs):
+    # channel -> programs, keeping the channels in the order they first show up
+    by_channel = {}
+    for p in programs:
+        by_channel.setdefault(p.channel, []).append(p)
+    return by_channel
+
+def __put(work_queue, item, failed):
+    # A bounded put that gives up once another stage has fallen over
+    while not failed.is_set():
+        try:
+            work_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+def __get(work_queue, failed):
+    while not failed.is_set():
+        try:
+            return work_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+    return DONE
+
+def run_pipeline(tvhd_programs, tvhd_channels, internet_programs, internet_channels, internet_index,
+                 movie_enricher, tv_enricher, location, queue_size=4, engine='window', delta=None):
+    # Match, enrich and write one channel at a time with each step in its own thread, so channel
+    # N+1 is being matched while channel N waits on the apis and channel N-1 is being written.
+    # The queues between them are bounded so a slow stage holds the others back instead of
+    # everything piling up in memory. Enrichment is all blocking requests, so it is a thread too.
+    # Every program written is also handed to delta (a GuideDelta), if there is one.
+    by_channel = __split_by_channel(tvhd_programs)
+    matched_queue = queue.Queue(maxsize=queue_size)
+    enriched_queue = queue.Queue(maxsize=queue_size)
+    failed = threading.Event()
+    errors = []
+
+    # One memo for the whole run so a repeat on another channel is still a hit
+    memo = EnrichmentMemo()
+    report = {'programs': len(tvhd_programs), 'matched': 0, 'successes': 0, 'skipped': 0, 'skip_reasons': {},
+              'memo_hits': 0, 'memo_hit_rate': 0}
+
+    def match_stage():
+        try:
+            for programs in by_channel.values():
+                programs, matches = match_headend_to_internet(programs, internet_programs, internet_channels,
+                                                              internet_index, engine=engine)
+                report['matched'] += len(matches)
+                __put(matched_queue, programs, failed)
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+        __put(matched_queue, DONE, failed)
+
+    # Progress over the whole run rather than starting again with every channel
+    enriched = itertools.count()
+    def progress():
+        n = next(enriched)
+        if n % 100 == 0:
+            print('Finished enriching {} of {} programs'.format(n, len(tvhd_programs)))
+
+    def enrich_stage():
+        try:
+            while True:
+                programs = __get(matched_queue, failed)
+                if programs is DONE:
+                    break
+
+                programs, enrich_report = enrich_programs(programs, movie_enricher, tv_enricher, memo=memo,
+                                                           progress=progress)
+                report['successes'] += enrich_report['successes']
+                report['skipped'] += enrich_report['skipped']
+                report['memo_hits'] += enrich_report['memo_hits']
+                report['memo_hit_rate'] = memo.hit_rate()
+                for reason, count in enrich_report['skip_reasons'].items():
+                    report['skip_reasons'][reason] = report['skip_reasons'].get(reason, 0) + count
+                __put(enriched_queue, programs, failed)
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+        __put(enriched_queue, DONE, failed)
+
+    threads = [threading.Thread(target=match_stage, name='match', daemon=True),
+               threading.Thread(target=enrich_stage, name='enrich', daemon=True)]
+    for t in threads:
+        t.start()
+
+    # Writing happens right here as the channels come through. It only replaces the old
+    # guide once everything made it.
+    written = False
+    try:
+        with open_xml_stream(location + '.tmp', tvhd_channels) as write_program:
+            while True:
+                programs = __get(enriched_queue, failed)
+                if programs is DONE:
+                    break
+                for p in programs:
+                    write_program(p)
+                    if delta is not None:
+                        delta.add(p)
+        written = True
+    except Exception:
+        failed.set()
+        raise
+    finally:
+        for t in threads:
+            t.join()
+        # Don't leave half a guide lying around
+        if (not written or errors) and os.path.exists(location + '.tmp'):
+            os.remove(location + '.tmp')
+
+    if errors:
+        raise errors[0]
+    os.replace(location + '.tmp', location)
+
+    return report
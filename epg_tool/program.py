@@ -1,5 +1,4 @@
 from datetime import datetime
-from lxml import etree
 
 class program:
 
@@ -94,6 +93,9 @@ class program:
             self.premiere = True
 
     def to_xml(self):
+        # Only writing needs lxml
+        from lxml import etree
+
         start = '{} {}'.format(self.start.strftime("%Y%m%d%H%M%S"), self.tz)
         stop = '{} {}'.format(self.stop.strftime("%Y%m%d%H%M%S"), self.tz)
         program = etree.Element('programme', start=start, stop=stop, channel=self.channel)
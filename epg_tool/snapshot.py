@@ -0,0 +1,211 @@
+import io
+import os
+import sys
+import mmap
+import json
+import array
+import struct
+import hashlib
+import urllib.request
+from epg_tool.channel import channel
+from epg_tool.program import program
+from epg_tool.index import guide_index, from_seconds
+
+# A snapshot is a parsed guide laid out in columns so it can be memory mapped back in:
+#
+#   MAGIC | header length (uint64) | json header | padding | column | padding | column ...
+#
+# Strings are interned into one table in the header and the string columns just hold int32
+# ids into it (-1 for None). Times are int64 seconds, flags are int8. Rows are in guide_index
+# order so the index columns are views straight onto the file.
+
+MAGIC = b'EPGSNAP1'
+SEPARATOR = '\x1f'
+
+STRING_COLUMNS = ['channel', 'title', 'sub_title', 'description', 'episode', 'norm_title',
+                  'norm_description', 'tz', 'icon', 'imdb_id', 'date', 'categories', 'ratings']
+INT_COLUMNS = {'start': 'q', 'stop': 'q', 'array_index': 'i', 'program_row': 'i',
+               'previously_shown': 'b', 'premiere': 'b'}
+
+class string_column:
+    # Looks like a list of strings, but is really ids into the string table
+
+    def __init__(self, ids, strings):
+        self.ids = ids
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        string_id = self.ids[row]
+        return self.strings[string_id] if string_id >= 0 else None
+
+    def __iter__(self):
+        strings = self.strings
+        for string_id in self.ids:
+            yield strings[string_id] if string_id >= 0 else None
+
+class snapshot_programs:
+    # The program list from a snapshot. Programs are only built when they are asked for and
+    # are kept after that, so changes made to them stick.
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.programs = {}
+
+    def __len__(self):
+        return len(self.columns['program_row'])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i not in self.programs:
+            self.programs[i] = self.__build(i)
+        return self.programs[i]
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += len(self)
+        self.programs[i] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __build(self, i):
+        row = self.columns['program_row'][i]
+        col = lambda name: self.columns[name][row]
+        categories = col('categories')
+        ratings = col('ratings')
+        return program(title=col('title'), start=from_seconds(col('start')), stop=from_seconds(col('stop')),
+                       channel=col('channel'), sub_title=col('sub_title'), description=col('description'),
+                       previously_shown=bool(col('previously_shown')), episode_num=col('episode'),
+                       ratings=ratings.split(SEPARATOR) if ratings is not None else None,
+                       categories=categories.split(SEPARATOR) if categories is not None else None,
+                       premiere=bool(col('premiere')), tz=col('tz'), icon=col('icon'),
+                       imdb_id=col('imdb_id'), date=col('date'))
+
+def save_snapshot(location, programs, channels, index=None, source_hash=None):
+    if index is None:
+        index = guide_index.from_programs(programs)
+
+    # Intern the strings as we go
+    strings = []
+    string_ids = {}
+    def intern(value):
+        if value is None:
+            return -1
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    columns = {name: array.array('i') for name in STRING_COLUMNS}
+    columns.update({name: array.array(code) for name, code in INT_COLUMNS.items()})
+    columns['program_row'] = array.array('i', [0] * len(programs))
+
+    for row in range(len(index)):
+        p = programs[index['array_index'][row]]
+        columns['program_row'][index['array_index'][row]] = row
+        for name in ['start', 'stop', 'array_index']:
+            columns[name].append(index[name][row])
+        for name in ['channel', 'title', 'sub_title', 'description', 'episode', 'norm_title', 'norm_description']:
+            columns[name].append(intern(index[name][row]))
+        columns['tz'].append(intern(p.tz))
+        columns['icon'].append(intern(p.icon))
+        columns['imdb_id'].append(intern(p.imdb_id))
+        columns['date'].append(intern(p.date))
+        columns['categories'].append(intern(SEPARATOR.join(p.categories) if p.categories else None))
+        columns['ratings'].append(intern(SEPARATOR.join(p.ratings) if p.ratings else None))
+        columns['previously_shown'].append(1 if p.previously_shown else 0)
+        columns['premiere'].append(1 if p.premiere else 0)
+
+    # Work out where every column lands. They all start on an 8 byte boundary.
+    layout = {}
+    offset = 0
+    for name, col in columns.items():
+        layout[name] = [offset, col.typecode, len(col)]
+        offset += (len(col) * col.itemsize + 7) // 8 * 8
+
+    header = {'byteorder': sys.byteorder,
+              'source_hash': source_hash,
+              'rows': len(index),
+              'strings': strings,
+              'channels': [[ch.id, ch.display_name, ch.lcn, ch.icon] for ch in channels.values()],
+              'columns': layout}
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    data_start = (len(MAGIC) + 8 + len(header) + 7) // 8 * 8
+
+    # Write it next door and swap it in, anything still mapping the old one keeps working
+    with open(location + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_start - f.tell()))
+        for name, col in columns.items():
+            raw = col.tobytes()
+            f.write(raw)
+            f.write(b'\0' * ((len(raw) + 7) // 8 * 8 - len(raw)))
+    os.replace(location + '.tmp', location)
+
+def __read_header(location):
+    # Returns the header and where the column data starts
+    with open(location, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a guide snapshot'.format(location))
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return (header, (len(MAGIC) + 8 + header_len + 7) // 8 * 8)
+
+def read_snapshot_header(location):
+    return __read_header(location)[0]
+
+def load_snapshot(location):
+    # Returns the same (programs, channels, index) as parse_xml
+    header, data_start = __read_header(location)
+    if header['byteorder'] != sys.byteorder:
+        raise ValueError('{} was written on a {} endian machine'.format(location, header['byteorder']))
+
+    with open(location, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+
+    strings = header['strings']
+    columns = {}
+    for name, (offset, typecode, length) in header['columns'].items():
+        start = data_start + offset
+        size = length * array.array(typecode).itemsize
+        col = view[start:start+size].cast(typecode)
+        if name in STRING_COLUMNS:
+            col = string_column(col, strings)
+        columns[name] = col
+
+    channels = {}
+    for ch_id, display_name, lcn, icon in header['channels']:
+        channels[ch_id] = channel(id=ch_id, display_name=display_name, lcn=lcn, icon=icon)
+
+    return (snapshot_programs(columns), channels, guide_index(columns))
+
+def parse_xml_cached(location, snapshot_location):
+    # parse_xml, unless the guide is byte for byte the same as the last time we snapshotted it
+    from epg_tool.xmltv import parse_xml
+
+    if '://' in location:
+        with urllib.request.urlopen(location) as response:
+            data = response.read()
+    else:
+        with open(location, 'rb') as f:
+            data = f.read()
+    source_hash = hashlib.sha1(data).hexdigest()
+
+    if os.path.isfile(snapshot_location):
+        try:
+            if read_snapshot_header(snapshot_location)['source_hash'] == source_hash:
+                return load_snapshot(snapshot_location)
+        except ValueError:
+            pass
+
+    programs, channels, index = parse_xml(io.BytesIO(data))
+    save_snapshot(snapshot_location, programs, channels, index=index, source_hash=source_hash)
+    return (programs, channels, index)
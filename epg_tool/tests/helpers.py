@@ -0,0 +1,74 @@
+import os
+from datetime import datetime, timedelta
+
+def make_guide(path, channels, programs):
+    # programs are (channel, start, minutes, title, description)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<tv>']
+    for ch_id, lcn in channels:
+        lines.append('<channel id="{}"><display-name>{}</display-name><lcn>{}</lcn></channel>'.format(ch_id, ch_id, lcn))
+    for ch_id, start, minutes, title, desc in programs:
+        stop = start + timedelta(minutes=minutes)
+        lines.append('<programme start="{} +1000" stop="{} +1000" channel="{}"><title>{}</title><desc>{}</desc></programme>'.format(
+            start.strftime('%Y%m%d%H%M%S'), stop.strftime('%Y%m%d%H%M%S'), ch_id, title, desc))
+    lines.append('</tv>')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+    return path
+
+def make_guides(directory):
+    # An internet guide and the headend's version of it - 5 minutes out, with decorated titles,
+    # missing descriptions and a typo. Returns (internet path, headend path).
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+
+    base = datetime(2020, 1, 1, 6)
+    internet = make_guide(os.path.join(directory, 'internet.xml'), [('abc.au', '2')], [
+        ('abc.au', base, 60, 'News', 'The news'),
+        ('abc.au', base + timedelta(hours=1), 60, 'Gardening Australia', 'Tips for spring'),
+        ('abc.au', base + timedelta(hours=2), 120, 'Better Off Dead', 'A teenager is dumped'),
+        ('abc.au', base + timedelta(hours=4), 60, 'News', 'More news'),
+    ])
+    headend = make_guide(os.path.join(directory, 'headend.xml'), [('1234', '2')], [
+        ('1234', base + timedelta(minutes=5), 60, 'News', 'The news'),
+        ('1234', base + timedelta(hours=1, minutes=5), 60, 'New: Gardening Australia (HD)', ''),
+        ('1234', base + timedelta(hours=2, minutes=5), 120, 'Movie: Better Off Dead', ''),
+        ('1234', base + timedelta(hours=4, minutes=5), 60, 'Newz', 'More news'),
+    ])
+    return (internet, headend)
+
+class FakeEnricher():
+    # Stands in for TMDBEnricher and TvMazeEnricher without going near the apis. Series are
+    # found if they are in episodes (title -> episode_num), or always with '0.0' when there
+    # is no episodes. Movies are always found. Every title looked up ends up in looked_up.
+    def __init__(self, episodes=None):
+        self.episodes = episodes
+        self.looked_up = []
+
+    def update_series_program(self, program):
+        self.looked_up.append(program.title)
+        if self.episodes is None:
+            program.episode_num = '0.0'
+        elif program.title in self.episodes:
+            program.episode_num = self.episodes[program.title]
+        else:
+            return (program, False)
+        program.categories = ['Found']
+        return (program, True)
+
+    def update_movie_program(self, program):
+        self.looked_up.append(program.title)
+        program.title = program.title.replace('Movie: ', '')
+        return (program, True)
+
+    def embed_stubbed_episode_info(self, program):
+        if not program.episode_num:
+            program.episode_num = 'stub {}'.format(program.start.hour)
+        return program
+
+class BrokenEnricher(FakeEnricher):
+    # Falls over on every lookup
+    def update_series_program(self, program):
+        raise ValueError('broken')
+
+    def update_movie_program(self, program):
+        raise ValueError('broken')
@@ -0,0 +1,46 @@
+import os
+import epg_tool
+from datetime import datetime, timedelta
+from helpers import make_guide, make_guides, FakeEnricher
+
+class TestBatch():
+    def setup_class(self):
+        self.dir = '/tmp/pytestbatch'
+        self.internet, self.headend = make_guides(self.dir)
+
+    def test_batch(self):
+        # Two regions on the same internet guide, and a third sharing a headend with the first
+        base = datetime(2020, 1, 1, 6)
+        other_headend = make_guide(os.path.join(self.dir, 'headend_2.xml'), [('5678', '2')], [
+            ('5678', base + timedelta(minutes=3), 60, 'News', 'The news'),
+            ('5678', base + timedelta(hours=1, minutes=3), 60, 'Gardening Australia', ''),
+        ])
+        sites = [(self.headend, self.internet, os.path.join(self.dir, 'batch_1.xml')),
+                 (other_headend, self.internet, os.path.join(self.dir, 'batch_2.xml')),
+                 (self.headend, self.internet, os.path.join(self.dir, 'batch_3.xml'))]
+
+        enricher = FakeEnricher()
+        report = epg_tool.run_batch(sites, enricher, enricher, max_workers=3)
+        assert report['guides_parsed'] == 3
+        assert report['programs'] == 10 and report['matched'] == 10
+        # Only the four different shows were looked up
+        assert sorted(enricher.looked_up) == ['Better Off Dead', 'Gardening Australia', 'News', 'News']
+
+        for _, _, output in sites:
+            written, _, _ = epg_tool.parse_xml(output)
+            assert [p.title for p in written][:2] == ['News', 'Gardening Australia']
+            assert all(p.episode_num == '0.0' for p in written)
+        written, _, _ = epg_tool.parse_xml(sites[1][2])
+        assert [p.start.minute for p in written] == [3, 3]
+
+    def test_batch_snapshots(self):
+        # The matching processes map the snapshots in themselves
+        snapshot_dir = os.path.join(self.dir, 'snapshots')
+        os.makedirs(snapshot_dir, exist_ok=True)
+        sites = [(self.headend, self.internet, os.path.join(self.dir, 'batch_snap.xml'))]
+        for _ in range(2):
+            report = epg_tool.run_batch(sites, FakeEnricher(), FakeEnricher(), snapshot_dir=snapshot_dir)
+            assert report['matched'] == 4
+
+        written, _, _ = epg_tool.parse_xml(sites[0][2])
+        assert [p.title for p in written] == ['News', 'Gardening Australia', 'Better Off Dead', 'News']
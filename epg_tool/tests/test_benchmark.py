@@ -0,0 +1,11 @@
+from epg_tool import benchmark
+
+class TestBenchmark():
+    def test_check_memory_budget(self):
+        results = [{'programs': 1000, 'bytes_per_program': 2500},
+                   {'programs': 10000, 'bytes_per_program': 2100},
+                   {'programs': 50000, 'bytes_per_program': 4200}]
+        assert benchmark.check_memory_budget(results, 5000) == []
+        assert benchmark.check_memory_budget(results, 4200) == []
+        assert benchmark.check_memory_budget(results, 4000) == [50000]
+        assert benchmark.check_memory_budget(results, 2000) == [1000, 10000, 50000]
@@ -0,0 +1,67 @@
+import pytest
+import requests
+from epg_tool.budget import RunBudget, EnrichmentUnavailable, call_with_retries
+
+class TestBudget():
+    def test_retries_are_bounded(self):
+        calls = []
+        def fail():
+            calls.append(1)
+            raise requests.exceptions.ConnectionError('down')
+
+        with pytest.raises(requests.exceptions.ConnectionError):
+            call_with_retries('fake', fail, retries=2, backoff=0)
+        assert len(calls) == 3
+
+    def test_max_calls(self):
+        budget = RunBudget(max_calls=2)
+        assert call_with_retries('fake', lambda: 1, budget=budget) == 1
+        assert call_with_retries('fake', lambda: 2, budget=budget) == 2
+        with pytest.raises(EnrichmentUnavailable):
+            call_with_retries('fake', lambda: 3, budget=budget)
+
+    def test_deadline(self):
+        budget = RunBudget(deadline=0)
+        with pytest.raises(EnrichmentUnavailable):
+            call_with_retries('fake', lambda: 1, budget=budget)
+
+    def test_circuit_breaker(self):
+        budget = RunBudget(failure_threshold=2, cooldown=60)
+        def fail():
+            raise requests.exceptions.ReadTimeout('slow')
+
+        # The breaker opens partway through the retries
+        with pytest.raises(EnrichmentUnavailable):
+            call_with_retries('fake', fail, budget=budget, retries=5, backoff=0)
+        with pytest.raises(EnrichmentUnavailable):
+            call_with_retries('fake', lambda: 1, budget=budget)
+
+        # Other providers are unaffected
+        assert call_with_retries('other', lambda: 1, budget=budget) == 1
+
+    def test_http_errors(self):
+        def http_error(status):
+            response = requests.Response()
+            response.status_code = status
+            calls = []
+            def fail():
+                calls.append(1)
+                raise requests.exceptions.HTTPError('{} error'.format(status), response=response)
+            return fail, calls
+
+        # Rate limits and server errors are retried and count toward the breaker
+        for status in [429, 503]:
+            budget = RunBudget(failure_threshold=10)
+            fail, calls = http_error(status)
+            with pytest.raises(requests.exceptions.HTTPError):
+                call_with_retries('tmdb', fail, budget=budget, retries=2, backoff=0)
+            assert len(calls) == 3
+            assert budget.failures['tmdb'] == 3
+
+        # Anything else is passed straight back
+        budget = RunBudget()
+        fail, calls = http_error(401)
+        with pytest.raises(requests.exceptions.HTTPError):
+            call_with_retries('tmdb', fail, budget=budget, retries=2, backoff=0)
+        assert len(calls) == 1
+        assert budget.failures.get('tmdb', 0) == 0
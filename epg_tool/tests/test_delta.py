@@ -0,0 +1,100 @@
+import os
+import socket
+import epg_tool
+from datetime import datetime, timedelta
+from epg_tool.channel import channel
+from epg_tool.program import program
+
+class FakeTvheadend():
+    # Stands in for tvheadend's external xmltv socket. The push is done once the sender has
+    # closed, so the connection waits in the backlog until we read it.
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.server.settimeout(5)
+
+    def receive(self):
+        # The programs in the next push
+        conn, _ = self.server.accept()
+        with conn:
+            data = b''
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        with open(self.path + '.received.xml', 'wb') as f:
+            f.write(data)
+        return [p.title for p in epg_tool.parse_xml(self.path + '.received.xml')[0]]
+
+    def close(self):
+        self.server.close()
+
+class TestDelta():
+    def setup_class(self):
+        self.dir = '/tmp/pytestdelta'
+        if not os.path.isdir(self.dir):
+            os.mkdir(self.dir)
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        self.channels = {'abc.au': channel(id='abc.au', display_name='ABC', lcn='2')}
+
+    def guide(self, titles):
+        base = datetime(2020, 1, 1, 6)
+        return [program(title=title, channel='abc.au', start=base + timedelta(hours=i), 
+                        stop=base + timedelta(hours=i+1), tz='+1000') for i, title in enumerate(titles)]
+
+    def test_only_changes_are_pushed(self):
+        location = os.path.join(self.dir, 'xmltv.xml')
+        tvheadend = FakeTvheadend(os.path.join(self.dir, 'xmltv.sock'))
+        try:
+            report = epg_tool.write_xml_delta(self.guide(['News', 'Bluey', 'Vera']), self.channels, location,
+                                              socket_path=tvheadend.path)
+            assert report['changed'] == 3 and report['pushed']
+            assert tvheadend.receive() == ['News', 'Bluey', 'Vera']
+
+            # One program changed and one more day on the end
+            report = epg_tool.write_xml_delta(self.guide(['News', 'Bluey', 'Landline', 'Insiders']), self.channels,
+                                              location, socket_path=tvheadend.path)
+            assert report['changed'] == 2 and report['pushed']
+            assert tvheadend.receive() == ['Landline', 'Insiders']
+
+            # Nothing changed - nothing to send
+            report = epg_tool.write_xml_delta(self.guide(['News', 'Bluey', 'Landline', 'Insiders']), self.channels,
+                                              location, socket_path=tvheadend.path)
+            assert report['changed'] == 0 and not report['pushed']
+        finally:
+            tvheadend.close()
+
+        # The full file is always there too
+        assert [p.title for p in epg_tool.parse_xml(location)[0]] == ['News', 'Bluey', 'Landline', 'Insiders']
+
+    def test_failed_push_is_retried(self):
+        location = os.path.join(self.dir, 'retry.xml')
+        report = epg_tool.write_xml_delta(self.guide(['News']), self.channels, location, 
+                                          socket_path=os.path.join(self.dir, 'nobody.sock'))
+        assert report['changed'] == 1 and not report['pushed']
+        assert os.path.isfile(location)
+
+        # Still not sent, so it is still a change
+        delta = epg_tool.GuideDelta(location + '.state')
+        for p in self.guide(['News']):
+            delta.add(p)
+        assert len(delta.changed) == 1
+
+    def test_program_hash(self):
+        from epg_tool.delta import program_hash
+        p = self.guide(['Vera'])[0]
+        before = program_hash(p)
+        # Not written to the guide, so not a change
+        p.imdb_id = 'tt0123456'
+        assert program_hash(p) == before
+        p.categories = ['Drama']
+        assert program_hash(p) != before
+        changed = program_hash(p)
+        p.premiere = True
+        assert program_hash(p) != changed
@@ -1,8 +1,12 @@
 import tmdbsimple as tmdb
 import os
+import json
+from datetime import datetime
 import epg_tool
+import pandas as pd
 from epg_tool.channel import channel
 from epg_tool.program import program
+from helpers import FakeEnricher
 
 class TestEnricher():
     def setup_class(self):
@@ -92,3 +96,157 @@ class TestEnricher():
         assert p_0.title == p_1.title == 'Better Off Dead..._(1985)'
         assert len(p_0.categories) > 0 and len(p_1.categories) > 0
         assert p_0.description is not None and p_1.description is not None
+
+class TestNegativeCache():
+    def setup_class(self):
+        self.cache = '/tmp/pytestnegativecache'
+        if not os.path.isdir(self.cache):
+            os.mkdir(self.cache)
+        if os.path.isfile(self.cache + '/negative_cache.json'):
+            os.remove(self.cache + '/negative_cache.json')
+
+    def test_record_miss(self):
+        enricher = epg_tool.TvMazeEnricher(self.cache)
+        p = program(title='Local News at 6', channel='fake')
+
+        assert not enricher.should_skip(p, 'series')
+        enricher.record_miss(p, 'series')
+        assert enricher.should_skip(p, 'series')
+        assert not enricher.should_skip(p, 'movie')
+
+        # It should survive being written and read back
+        enricher.write_negative_cache()
+        enricher = epg_tool.TvMazeEnricher(self.cache)
+        assert enricher.should_skip(program(title=' local news  at 6', channel='fake'), 'series')
+
+    def test_skip_patterns(self):
+        enricher = epg_tool.TvMazeEnricher(self.cache, skip_patterns=[r'\bnews\b', '^paid programming$'])
+        assert enricher.should_skip(program(title='Nine News'), 'series')
+        assert enricher.should_skip(program(title='Paid Programming'), 'movie')
+        assert not enricher.should_skip(program(title='Newsroom'), 'series')
+
+class TestEnrichmentMemo():
+    def test_repeats_are_enriched_once(self):
+        tv = FakeEnricher(episodes={'Bluey': '1.4'})
+        programs = [program(title='Bluey', sub_title='Camping', channel='abc', start=datetime(2020, 1, 1, 7)),
+                    program(title='Bluey (HD)', sub_title='Camping', channel='abchd', start=datetime(2020, 1, 1, 7)),
+                    program(title='Local News', channel='abc', start=datetime(2020, 1, 1, 18)),
+                    program(title='Local News', channel='abc', start=datetime(2020, 1, 1, 23))]
+        memo = epg_tool.enricher.EnrichmentMemo()
+        progs, report = epg_tool.enrich_programs(programs, None, tv, memo=memo)
+
+        assert tv.looked_up == ['Bluey', 'Local News']
+        assert report['memo_hits'] == 2 and memo.hit_rate() == 0.5
+        assert report['successes'] == 2
+        assert progs[1].episode_num == '1.4' and progs[1].categories == ['Found']
+        assert progs[1].channel == 'abchd'
+        # Stubs still depend on when it airs
+        assert progs[2].episode_num == 'stub 18' and progs[3].episode_num == 'stub 23'
+
+class TestSharedCache():
+    def setup_class(self):
+        self.cache = '/tmp/pytestsharedcache'
+        if not os.path.isdir(self.cache):
+            os.mkdir(self.cache)
+        for name in os.listdir(self.cache):
+            os.remove(os.path.join(self.cache, name))
+
+    def test_series_csv_is_merged(self):
+        # Two jobs start from the same cache and each find a different show
+        job_1 = epg_tool.TvMazeEnricher(self.cache)
+        job_2 = epg_tool.TvMazeEnricher(self.cache)
+        job_1.series_df = pd.DataFrame([dict(series_name='Bluey', channel_id='abc', imdb_id=None, enricher_id=1)])
+        job_2.series_df = pd.DataFrame([dict(series_name='Vera', channel_id='abc', imdb_id='tt1', enricher_id=2)])
+
+        job_1.write_series_csv()
+        job_2.write_series_csv()
+        job_1.write_series_csv()
+
+        merged = pd.read_csv(self.cache + '/show_dataframe.csv')
+        assert sorted(merged['series_name']) == ['Bluey', 'Vera']
+
+    def test_negative_cache_is_merged(self):
+        job_1 = epg_tool.TvMazeEnricher(self.cache)
+        job_2 = epg_tool.TvMazeEnricher(self.cache)
+        job_1.record_miss(program(title='Local News', channel='abc'), 'series')
+        job_2.record_miss(program(title='Sport', channel='abc'), 'series')
+        job_1.write_negative_cache()
+        job_2.write_negative_cache()
+
+        job_3 = epg_tool.TvMazeEnricher(self.cache)
+        assert job_3.should_skip(program(title='Local News', channel='abc'), 'series')
+        assert job_3.should_skip(program(title='Sport', channel='abc'), 'series')
+
+    def test_atomic_write(self):
+        from epg_tool.cache import atomic_write
+        atomic_write(self.cache + '/atomic.txt', 'hello')
+        with open(self.cache + '/atomic.txt') as f:
+            assert f.read() == 'hello'
+        assert not [name for name in os.listdir(self.cache) if name.endswith('.tmp')]
+
+        # Same permissions as a plain open() would give, and whatever the old file had after that
+        with open(self.cache + '/plain.txt', 'w') as f:
+            f.write('hello')
+        assert os.stat(self.cache + '/atomic.txt').st_mode == os.stat(self.cache + '/plain.txt').st_mode
+        os.chmod(self.cache + '/atomic.txt', 0o640)
+        atomic_write(self.cache + '/atomic.txt', 'again')
+        assert os.stat(self.cache + '/atomic.txt').st_mode & 0o777 == 0o640
+
+    def test_atomic_write_umask(self):
+        # Working out the mode mustn't touch the process umask, other threads are creating files too
+        import subprocess
+        import sys
+        script = ('import os; os.umask(0o027); from epg_tool.cache import atomic_write; '
+                  'atomic_write({!r}, "hello"); print(oct(os.umask(0o022)))').format(self.cache + '/umask.txt')
+        if os.path.exists(self.cache + '/umask.txt'):
+            os.remove(self.cache + '/umask.txt')
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(epg_tool.__file__)))
+        assert output.decode().strip() == '0o27'
+        assert os.stat(self.cache + '/umask.txt').st_mode & 0o777 == 0o640
+
+class TestCacheMaintenance():
+    def setup_method(self):
+        self.cache = '/tmp/pytestcachemaintenance'
+        if not os.path.isdir(self.cache):
+            os.mkdir(self.cache)
+        for name in os.listdir(self.cache):
+            os.remove(os.path.join(self.cache, name))
+
+    def test_old_cache_is_compacted(self):
+        # What older versions left behind - indented json and a csv full of repeats
+        episodes = [{'name': 'Episode {}'.format(i), 'summary': 'Something happens'} for i in range(50)]
+        with open(self.cache + '/1_episode_info.json', 'w') as f:
+            json.dump(episodes, f, indent=4)
+        row = dict(series_name='Bluey', channel_id='abc', imdb_id=None, enricher_id=1)
+        pd.DataFrame([row] * 5).to_csv(self.cache + '/show_dataframe.csv', index=False)
+
+        enricher = epg_tool.GenericEnricher(self.cache, compress=True)
+        report = enricher.maintain_cache()
+        assert report['rewritten'] == 1 and report['duplicate_series_rows'] == 4
+        assert report['reclaimed'] > 0
+        assert os.listdir(self.cache).count('1_episode_info.json.gz') == 1
+        assert '1_episode_info.json' not in os.listdir(self.cache)
+
+        # Old and new readers both find it
+        assert enricher.get_episode_info(1) == episodes
+        assert epg_tool.TvMazeEnricher(self.cache).get_episode_info(1) == episodes
+
+    def test_eviction(self):
+        enricher = epg_tool.GenericEnricher(self.cache)
+        for i in range(4):
+            enricher.save_series_info({'name': 'x' * 1000}, i)
+        enricher.write_cache_index()
+
+        # 0 is the oldest, but we keep using it
+        for _ in range(3):
+            enricher.get_series_info(0)
+        enricher.get_series_info(1)
+
+        lru = epg_tool.GenericEnricher(self.cache, max_bytes=2500)
+        lru.cache_access = enricher.cache_access
+        assert sorted(lru.write_cache_index()) == ['2.json', '3.json']
+        assert sorted(name for name in os.listdir(self.cache) if name[0].isdigit()) == ['0.json', '1.json']
+
+        lfu = epg_tool.GenericEnricher(self.cache, max_bytes=1500, eviction='lfu')
+        assert lfu.write_cache_index() == ['1.json']
+        assert lfu.get_series_info(0) == {'name': 'x' * 1000}
@@ -0,0 +1,125 @@
+import os
+import epg_tool
+from datetime import datetime, timedelta
+from epg_tool.normalize import normalize_title, normalize_text
+from helpers import make_guide, make_guides
+
+class TestParser():
+    def setup_class(self):
+        self.dir = '/tmp/pytestparser'
+        self.internet, self.headend = make_guides(self.dir)
+
+    def test_normalize(self):
+        assert normalize_title('New: Movie: Better Off Dead... (HD)') == 'better off dead'
+        assert normalize_title('  Law & Order [R]') == 'law and order'
+        assert normalize_text('Hello,  World!') == 'hello world'
+        assert normalize_title(None) is None
+
+    def test_parse_xml(self):
+        programs, channels, index = epg_tool.parse_xml(self.headend)
+        assert len(programs) == 4
+        assert channels['1234'].lcn == '2'
+        assert index['norm_title'][1] == 'gardening australia'
+
+    def test_match(self):
+        int_programs, int_channels, int_index = epg_tool.parse_xml(self.internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(self.headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        tvhd_programs, matches = epg_tool.match_headend_to_internet(tvhd_programs, int_programs, 
+                                                                    int_channels, int_index)
+        assert matches == [0, 1, 2, 3]
+        assert [p.title for p in tvhd_programs] == ['News', 'Gardening Australia', 'Better Off Dead', 'News']
+        assert tvhd_programs[3].description == 'More news'
+
+    def test_channel_offsets(self):
+        # The internet guide is 3 hours out and the same episode repeats 2 hours later
+        base = datetime(2020, 1, 1, 6)
+        titles = ['Bluey', 'Play School', 'Peppa Pig', 'Bluey', 'Octonauts', 'Hey Duggee']
+        internet = make_guide(os.path.join(self.dir, 'internet_offset.xml'), [('abc2.au', '22')], 
+            [('abc2.au', base + timedelta(hours=3, minutes=30*i), 30, t, 'Episode {}'.format(i)) for i, t in enumerate(titles)])
+        headend = make_guide(os.path.join(self.dir, 'headend_offset.xml'), [('5678', '22')], 
+            [('5678', base + timedelta(minutes=30*i), 30, t, '') for i, t in enumerate(titles)])
+
+        int_programs, int_channels, int_index = epg_tool.parse_xml(internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        offsets = epg_tool.estimate_channel_offsets(tvhd_programs, int_index)
+        assert offsets == {'abc2.au': timedelta(hours=3)}
+
+        tvhd_programs, matches = epg_tool.match_headend_to_internet(tvhd_programs, int_programs, 
+                                                                    int_channels, int_index)
+        assert matches == list(range(len(titles)))
+        assert [p.description for p in tvhd_programs] == ['Episode {}'.format(i) for i in range(len(titles))]
+
+    def test_moved_program(self):
+        # The clocks agree, but one program got pushed back 40 minutes by an overrun
+        base = datetime(2020, 1, 1, 6)
+        titles = ['Bluey', 'Play School', 'Peppa Pig', 'Octonauts', 'Hey Duggee', 'Landline']
+        moved = lambda i: timedelta(minutes=40) if i == 4 else timedelta(0)
+        internet = make_guide(os.path.join(self.dir, 'internet_moved.xml'), [('abc3.au', '23')], 
+            [('abc3.au', base + timedelta(hours=i) + moved(i), 30, t, 'Episode {}'.format(i)) for i, t in enumerate(titles)])
+        headend = make_guide(os.path.join(self.dir, 'headend_moved.xml'), [('9012', '23')], 
+            [('9012', base + timedelta(hours=i), 30, t, '') for i, t in enumerate(titles)])
+
+        int_programs, int_channels, int_index = epg_tool.parse_xml(internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        tvhd_programs, matches = epg_tool.match_headend_to_internet(tvhd_programs, int_programs, 
+                                                                    int_channels, int_index)
+        assert matches == list(range(len(titles)))
+        assert tvhd_programs[4].description == 'Episode 4'
+
+    def test_repeated_title(self):
+        # Three episodes back to back, the headend 20 minutes fast and its descriptions worded a little differently
+        base = datetime(2020, 1, 1, 19)
+        int_descs = ['Ross finds out that Rachel has feelings for him while he is away in China',
+                     'Monica and Rachel make a bet with Joey and Chandler about who knows the other pair best',
+                     'Phoebe is pregnant with triplets for her brother Frank and his wife Alice']
+        hd_descs = ['While away in China Ross finds out Rachel has feelings for him.',
+                    'Monica and Rachel bet Joey and Chandler about who knows the other pair best.',
+                    'Phoebe is now pregnant with triplets for her brother Frank and his wife Alice.']
+        internet = make_guide(os.path.join(self.dir, 'internet_repeat.xml'), [('ten.au', '10')],
+            [('ten.au', base + timedelta(minutes=30*i), 30, 'Friends', d) for i, d in enumerate(int_descs)])
+        headend = make_guide(os.path.join(self.dir, 'headend_repeat.xml'), [('3456', '10')],
+            [('3456', base + timedelta(minutes=30*i + 20), 30, 'Friends', d) for i, d in enumerate(hd_descs)])
+
+        int_programs, int_channels, int_index = epg_tool.parse_xml(internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        tvhd_programs, matches = epg_tool.match_headend_to_internet(tvhd_programs, int_programs,
+                                                                    int_channels, int_index)
+        assert matches == [0, 1, 2]
+        assert [p.description for p in tvhd_programs] == int_descs
+
+    def test_sequence_match(self):
+        int_programs, int_channels, int_index = epg_tool.parse_xml(self.internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(self.headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        tvhd_programs, matches = epg_tool.match_headend_to_internet(tvhd_programs, int_programs, int_channels, 
+                                                                    int_index, engine='sequence')
+        # "Newz" isn't close enough on title alone
+        assert matches == [0, 1, 2]
+        assert [p.description for p in tvhd_programs[:3]] == ['The news', 'Tips for spring', 'A teenager is dumped']
+
+    def test_sequence_match_keeps_order(self):
+        # A repeat of the same title should line up with the right airing
+        base = datetime(2020, 1, 1, 6)
+        titles = ['Bluey', 'Play School', 'Bluey', 'Peppa Pig', 'Octonauts', 'Hey Duggee']
+        internet = make_guide(os.path.join(self.dir, 'internet_seq.xml'), [('abc3.au', '23')], 
+            [('abc3.au', base + timedelta(hours=1, minutes=30*i), 30, t, 'Episode {}'.format(i)) for i, t in enumerate(titles)])
+        headend = make_guide(os.path.join(self.dir, 'headend_seq.xml'), [('9012', '23')], 
+            [('9012', base + timedelta(minutes=30*i), 30, t, '') for i, t in enumerate(titles)])
+
+        int_programs, int_channels, int_index = epg_tool.parse_xml(internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        tvhd_programs, matches = epg_tool.match_headend_to_internet(tvhd_programs, int_programs, int_channels, 
+                                                                    int_index, engine='sequence', band=2)
+        assert matches == list(range(len(titles)))
+        assert [p.description for p in tvhd_programs] == ['Episode {}'.format(i) for i in range(len(titles))]
@@ -0,0 +1,44 @@
+import os
+import pytest
+import epg_tool
+from helpers import make_guides, FakeEnricher, BrokenEnricher
+
+class TestPipeline():
+    def setup_class(self):
+        self.dir = '/tmp/pytestpipeline'
+        self.internet, self.headend = make_guides(self.dir)
+
+    def test_pipeline(self):
+        int_programs, int_channels, int_index = epg_tool.parse_xml(self.internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(self.headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        location = os.path.join(self.dir, 'pipeline.xml')
+        if os.path.isfile(location + '.state'):
+            os.remove(location + '.state')
+        delta = epg_tool.GuideDelta(location + '.state')
+        report = epg_tool.run_pipeline(tvhd_programs, tvhd_channels, int_programs, int_channels, int_index,
+                                       FakeEnricher(), FakeEnricher(), location, queue_size=1, delta=delta)
+        assert report['matched'] == 4
+        assert report['successes'] == 4
+        assert len(delta.changed) == 4
+
+        written, written_channels, _ = epg_tool.parse_xml(location)
+        assert [p.title for p in written] == ['News', 'Gardening Australia', 'Better Off Dead', 'News']
+        assert [p.episode_num for p in written] == ['0.0', '0.0', '0.0', '0.0']
+        assert list(written_channels.keys()) == ['abc.au']
+
+    def test_pipeline_failure(self):
+        int_programs, int_channels, int_index = epg_tool.parse_xml(self.internet)
+        tvhd_programs, tvhd_channels, _ = epg_tool.parse_xml(self.headend)
+        tvhd_channels, tvhd_programs = epg_tool.transfer_channel_ids(tvhd_channels, tvhd_programs, int_channels)
+
+        location = os.path.join(self.dir, 'pipeline_failure.xml')
+        with open(location, 'w') as f:
+            f.write('the last good guide')
+        with pytest.raises(ValueError):
+            epg_tool.run_pipeline(tvhd_programs, tvhd_channels, int_programs, int_channels, int_index,
+                                  BrokenEnricher(), BrokenEnricher(), location)
+        assert not os.path.exists(location + '.tmp')
+        with open(location) as f:
+            assert f.read() == 'the last good guide'
@@ -0,0 +1,35 @@
+import os
+import epg_tool
+from helpers import make_guides
+
+class TestSnapshot():
+    def setup_class(self):
+        self.dir = '/tmp/pytestsnapshot'
+        self.internet, self.headend = make_guides(self.dir)
+
+    def test_snapshot(self):
+        programs, channels, index = epg_tool.parse_xml(self.internet)
+        epg_tool.save_snapshot(os.path.join(self.dir, 'internet.snap'), programs, channels, index=index)
+        snap_programs, snap_channels, snap_index = epg_tool.load_snapshot(os.path.join(self.dir, 'internet.snap'))
+
+        assert len(snap_programs) == len(programs)
+        for p, snap_p in zip(programs, snap_programs):
+            assert vars(p) == vars(snap_p)
+        assert snap_channels['abc.au'].lcn == '2'
+        assert list(snap_index['norm_title']) == list(index['norm_title'])
+        assert list(snap_index.rows('abc.au', index['start'][1], index['start'][2])) == [1, 2]
+
+        # Changes to the programs should stick
+        snap_programs[0].title = 'Changed'
+        assert snap_programs[0].title == 'Changed'
+
+    def test_parse_xml_cached(self):
+        snap = os.path.join(self.dir, 'cached.snap')
+        if os.path.isfile(snap):
+            os.remove(snap)
+
+        programs, _, _ = epg_tool.parse_xml_cached(self.internet, snap)
+        assert isinstance(programs, list)
+        cached_programs, _, _ = epg_tool.parse_xml_cached(self.internet, snap)
+        assert not isinstance(cached_programs, list)
+        assert [p.title for p in cached_programs] == [p.title for p in programs]
@@ -0,0 +1,112 @@
+import os
+import time
+import pytest
+import sqlite3
+import threading
+import epg_tool
+from datetime import datetime
+from epg_tool.program import program
+from helpers import FakeEnricher, BrokenEnricher
+
+class TestWorkQueue():
+    def setup_class(self):
+        self.broker_location = '/tmp/pytestbroker.db'
+        if os.path.isfile(self.broker_location):
+            os.remove(self.broker_location)
+
+    def test_enrich_distributed(self):
+        broker = epg_tool.SQLiteBroker(self.broker_location)
+        programs = []
+        for hour in range(6, 12):
+            programs.append(program(title='Bluey', channel='abc', start=datetime(2020, 1, 1, hour), 
+                                    stop=datetime(2020, 1, 1, hour, 30)))
+            programs.append(program(title='Local News', channel='abc', start=datetime(2020, 1, 1, hour, 30), 
+                                    stop=datetime(2020, 1, 1, hour+1)))
+        programs.append(program(title='Movie: Better Off Dead', channel='abc', start=datetime(2020, 1, 1, 12), 
+                                stop=datetime(2020, 1, 1, 14)))
+
+        # Another worker helping out
+        worker_tv = FakeEnricher(episodes={'Bluey': '1.4'})
+        worker = threading.Thread(target=epg_tool.run_worker, 
+                                  args=(broker, worker_tv, worker_tv), kwargs={'idle_timeout': 1, 'poll': 0.1})
+        worker.start()
+
+        tv = FakeEnricher(episodes={'Bluey': '1.4'})
+        progs, report = epg_tool.enrich_distributed(programs, broker, tv, tv, timeout=30, poll=0.1)
+        worker.join()
+
+        # Three unique things to enrich, split between the two of them
+        assert report['tasks'] == 3
+        assert sorted(tv.looked_up + worker_tv.looked_up) == ['Bluey', 'Local News', 'Movie: Better Off Dead']
+        assert report['successes'] == 7
+        assert [p.episode_num for p in progs[:4]] == ['1.4', 'stub 6', '1.4', 'stub 7']
+        assert progs[-1].title == 'Better Off Dead'
+        assert broker.results('anything') == {}
+
+    def test_timeout(self):
+        broker = epg_tool.SQLiteBroker(self.broker_location)
+        # Nobody is going to do this one - it is already claimed
+        broker.publish('other', {'x': {}})
+        broker.claim('busy')
+
+        tv = FakeEnricher(episodes={'Bluey': '1.4'})
+        p = program(title='Bluey', channel='abc', start=datetime(2020, 1, 1, 6), stop=datetime(2020, 1, 1, 7))
+        # Stop the coordinator from doing the work itself
+        claim = broker.claim
+        broker.claim = lambda worker_id: None
+        progs, report = epg_tool.enrich_distributed([p], broker, tv, tv, timeout=0.2, poll=0.1)
+        broker.claim = claim
+
+        assert report['skipped'] == 1 and report['successes'] == 0
+        assert progs[0].episode_num == 'stub 6'
+
+    def test_throttle(self):
+        broker = epg_tool.SQLiteBroker(self.broker_location)
+        tic = time.monotonic()
+        for _ in range(3):
+            broker.throttle('fake', 0.1)
+        assert time.monotonic() - tic >= 0.2
+
+    def test_dead_runs_are_dropped(self):
+        broker = epg_tool.SQLiteBroker(self.broker_location, lease=0.2)
+        broker.publish('crashed', {'x': {}})
+        time.sleep(0.3)
+        # Its coordinator stopped checking in, so nobody works on it
+        assert broker.claim('worker') is None
+        assert broker.results('crashed') == {}
+
+    def test_poison_task(self):
+        broker = epg_tool.SQLiteBroker(self.broker_location)
+        broker.publish('poison', {'x': {'title': 'Bluey'}})
+        # The bad task is finished as a failure and the worker carries on
+        assert epg_tool.run_worker(broker, BrokenEnricher(), BrokenEnricher(), idle_timeout=0, poll=0) == 1
+        result = broker.results('poison')['x']
+        assert not result['success'] and result['error'].startswith('KeyError')
+        broker.clear('poison')
+
+        p = program(title='Bluey', channel='abc', start=datetime(2020, 1, 1, 6), stop=datetime(2020, 1, 1, 7))
+        progs, report = epg_tool.enrich_distributed([p], broker, FakeEnricher(), BrokenEnricher(), poll=0.1)
+        assert report['skipped'] == 1 and report['successes'] == 0
+        assert list(report['skip_reasons']) == ['Failed on the worker (ValueError: broken)']
+        assert progs[0].episode_num == 'stub 6'
+
+    def test_run_is_cleared_on_error(self):
+        broker = epg_tool.SQLiteBroker(self.broker_location)
+        p = program(title='Bluey', channel='abc', start=datetime(2020, 1, 1, 6), stop=datetime(2020, 1, 1, 7))
+        def broken_claim(worker_id):
+            raise sqlite3.OperationalError('disk I/O error')
+        broker.claim = broken_claim
+        with pytest.raises(sqlite3.OperationalError):
+            epg_tool.enrich_distributed([p], broker, FakeEnricher(), FakeEnricher(), poll=0.1)
+        with sqlite3.connect(self.broker_location) as db:
+            assert db.execute("SELECT COUNT(*) FROM tasks WHERE task LIKE '%Bluey%'").fetchone()[0] == 0
+
+    def test_incomplete_broker(self):
+        from epg_tool.workqueue import Broker
+
+        class HalfBroker(Broker):
+            def publish(self, run, tasks):
+                pass
+
+        with pytest.raises(TypeError):
+            HalfBroker()
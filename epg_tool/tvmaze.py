@@ -1,39 +1,38 @@
-import time
 import requests
+from epg_tool.budget import call_with_retries
 
 URL = 'http://api.tvmaze.com'
 
-def __get(url, params):
-    try:
-        response = requests.get(url, params, timeout=10)
-    except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
-        print('Got hit with a retryable exception. Sleeping for 30 seconds and going at it again: {}'.format(e))
-        time.sleep(30)
-        return __get(url, params)
+def __request(url, params):
+    response = requests.get(url, params, timeout=10)
+    if response.status_code == 429 or response.status_code >= 500:
+        # Let call_with_retries back off and have another go
+        raise requests.exceptions.RetryError('Got status {} from {}'.format(response.status_code, url))
+    return response
+
+def __get(url, params, budget=None):
+    response = call_with_retries('tvmaze', lambda: __request(url, params), budget=budget)
 
     if response.status_code == 200:
         return response.json()
-    elif response.status_code == 429:
-        time.sleep(10)
-        return __get(url, params)
     else:
         return None
 
-def search_for_show(query):
+def search_for_show(query, budget=None):
     url = URL + '/singlesearch/shows'
     params = {'q':query}
-    return __get(url, params)
+    return __get(url, params, budget=budget)
 
-def get_show_by_imdbid(query):
+def get_show_by_imdbid(query, budget=None):
     url = URL + '/lookup/shows'
     params = {'imdb':query}
-    return __get(url, params)
+    return __get(url, params, budget=budget)
 
-def get_show_info(tvmaze_id):
+def get_show_info(tvmaze_id, budget=None):
     url = URL + '/shows/{}'.format(tvmaze_id)
-    return __get(url, None)
+    return __get(url, None, budget=budget)
 
-def get_episode_info(tvmaze_id):
+def get_episode_info(tvmaze_id, budget=None):
     url = URL + '/shows/{}/episodes'.format(tvmaze_id)
     params = {'specials':1}
-    return __get(url, params)
\ No newline at end of file
+    return __get(url, params, budget=budget)
@@ -0,0 +1,299 @@
+import os
+import abc
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import datetime
+from epg_tool.program import program
+from epg_tool.enricher import EnrichmentMemo, ENRICHED_FIELDS, enrich_programs
+
+# Seconds between calls to each provider, shared by every worker on the broker
+RATE_LIMITS = {'tvmaze': 0.5, 'tmdb': 0.05}
+
+# Program fields a worker needs to enrich something
+TASK_FIELDS = ['title', 'sub_title', 'description', 'channel', 'imdb_id', 'categories', 'episode_num',
+               'date', 'tz']
+
+class Broker(abc.ABC):
+    # What the coordinator and the workers talk through. Tasks and results are plain dicts.
+
+    @abc.abstractmethod
+    def publish(self, run, tasks):
+        # tasks is {task id: task}
+        pass
+
+    @abc.abstractmethod
+    def heartbeat(self, run):
+        # The coordinator is still waiting on run. Runs that stop calling this get dropped.
+        pass
+
+    @abc.abstractmethod
+    def claim(self, worker_id):
+        # Returns (run, task id, task) or None when there is nothing to do
+        pass
+
+    @abc.abstractmethod
+    def complete(self, run, task_id, result):
+        pass
+
+    @abc.abstractmethod
+    def finished(self, run):
+        # How many of run's tasks are done, without fetching them
+        pass
+
+    @abc.abstractmethod
+    def results(self, run):
+        # {task id: result} for everything finished so far
+        pass
+
+    @abc.abstractmethod
+    def clear(self, run):
+        pass
+
+    @abc.abstractmethod
+    def throttle(self, provider, interval):
+        # Block until this provider can be called again, across every worker
+        pass
+
+class SQLiteBroker(Broker):
+    # A broker in a single SQLite file - fine for several workers on one machine or a
+    # stand-in for something bigger. Claimed tasks that aren't finished within lease
+    # seconds are handed out again, so a dead worker doesn't lose them. Runs whose coordinator
+    # hasn't checked in for lease seconds are thrown away, so a dead coordinator doesn't
+    # keep the workers busy.
+
+    def __init__(self, location, lease=600):
+        self.location = location
+        self.lease = lease
+        db = self.__connect()
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS tasks (run TEXT, id TEXT, task TEXT, status TEXT, '
+                       'worker TEXT, claimed REAL, result TEXT, PRIMARY KEY (run, id))')
+            db.execute('CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, heartbeat REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS rate_limits (provider TEXT PRIMARY KEY, next REAL)')
+        finally:
+            db.close()
+
+    def __connect(self):
+        # We do our own transactions
+        return sqlite3.connect(self.location, timeout=60, isolation_level=None)
+
+    def __transaction(self, func):
+        # BEGIN IMMEDIATE takes the write lock up front so two workers can't claim the same task
+        db = self.__connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            result = func(db)
+            db.execute('COMMIT')
+            return result
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+    def publish(self, run, tasks):
+        rows = [(run, task_id, json.dumps(task), 'pending') for task_id, task in tasks.items()]
+        def insert(db):
+            db.execute('INSERT OR REPLACE INTO runs (run, heartbeat) VALUES (?, ?)', (run, time.time()))
+            db.executemany('INSERT OR IGNORE INTO tasks (run, id, task, status) VALUES (?, ?, ?, ?)', rows)
+        self.__transaction(insert)
+
+    def heartbeat(self, run):
+        self.__transaction(lambda db: db.execute('UPDATE runs SET heartbeat = ? WHERE run = ?', (time.time(), run)))
+
+    def claim(self, worker_id):
+        def claim_one(db):
+            now = time.time()
+            # Nobody is waiting on these any more
+            db.execute('DELETE FROM runs WHERE heartbeat < ?', (now - self.lease,))
+            db.execute('DELETE FROM tasks WHERE run NOT IN (SELECT run FROM runs)')
+
+            row = db.execute("SELECT run, id, task FROM tasks WHERE status = 'pending' "
+                             "OR (status = 'claimed' AND claimed < ?) LIMIT 1", (now - self.lease,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE tasks SET status = 'claimed', worker = ?, claimed = ? WHERE run = ? AND id = ?",
+                       (worker_id, now, row[0], row[1]))
+            return (row[0], row[1], json.loads(row[2]))
+        return self.__transaction(claim_one)
+
+    def complete(self, run, task_id, result):
+        self.__transaction(lambda db: db.execute(
+            "UPDATE tasks SET status = 'done', result = ? WHERE run = ? AND id = ?",
+            (json.dumps(result), run, task_id)))
+
+    def finished(self, run):
+        db = self.__connect()
+        try:
+            return db.execute("SELECT COUNT(*) FROM tasks WHERE run = ? AND status = 'done'", (run,)).fetchone()[0]
+        finally:
+            db.close()
+
+    def results(self, run):
+        db = self.__connect()
+        try:
+            rows = db.execute("SELECT id, result FROM tasks WHERE run = ? AND status = 'done'", (run,)).fetchall()
+        finally:
+            db.close()
+        return {task_id: json.loads(result) for task_id, result in rows}
+
+    def clear(self, run):
+        def delete(db):
+            db.execute('DELETE FROM tasks WHERE run = ?', (run,))
+            db.execute('DELETE FROM runs WHERE run = ?', (run,))
+        self.__transaction(delete)
+
+    def throttle(self, provider, interval):
+        def reserve(db):
+            now = time.time()
+            row = db.execute('SELECT next FROM rate_limits WHERE provider = ?', (provider,)).fetchone()
+            slot = max(now, row[0]) if row else now
+            db.execute('INSERT OR REPLACE INTO rate_limits (provider, next) VALUES (?, ?)', (provider, slot + interval))
+            return slot - now
+        wait = self.__transaction(reserve)
+        if wait > 0:
+            time.sleep(wait)
+
+def broker_throttle(broker):
+    # Hand this to RunBudget(throttle=...) to share the provider rate limits through the broker
+    return lambda provider: broker.throttle(provider, RATE_LIMITS.get(provider, 0))
+
+def __task_id(key):
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+def __to_task(p):
+    task = {name: getattr(p, name) for name in TASK_FIELDS}
+    task['start'] = p.start.strftime('%Y%m%d%H%M%S')
+    task['stop'] = p.stop.strftime('%Y%m%d%H%M%S')
+    return task
+
+def __from_task(task):
+    p = program(**{name: task[name] for name in TASK_FIELDS})
+    p.start = datetime.datetime.strptime(task['start'], '%Y%m%d%H%M%S')
+    p.stop = datetime.datetime.strptime(task['stop'], '%Y%m%d%H%M%S')
+    return p
+
+def __to_json(value):
+    # airdate ends up as a datetime
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+def __work_one(broker, claimed, movie_enricher, tv_enricher):
+    run, task_id, task = claimed
+    try:
+        programs, report = enrich_programs([__from_task(task)], movie_enricher, tv_enricher, progress=False)
+    except Exception as e:
+        # A payload the enrichers choke on would do the same to every worker that picked it up
+        # next, so it is finished here as a failure
+        print('Could not enrich {}: {!r}'.format(task.get('title'), e))
+        broker.complete(run, task_id, {'fields': None, 'success': False, 'skipped': True,
+                                       'error': '{}: {}'.format(type(e).__name__, e)})
+        return
+    result = {'fields': {name: __to_json(getattr(programs[0], name)) for name in ENRICHED_FIELDS},
+              'success': report['successes'] == 1,
+              'skipped': report['skipped'] == 1}
+    broker.complete(run, task_id, result)
+
+def run_worker(broker, movie_enricher, tv_enricher, worker_id=None, idle_timeout=None, poll=5):
+    # Enrich whatever the broker hands out. Returns how many tasks were done once there has
+    # been nothing to do for idle_timeout seconds (or never, if that is None).
+    if worker_id is None:
+        worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+    done = 0
+    idle_since = time.monotonic()
+    while True:
+        claimed = broker.claim(worker_id)
+        if claimed is None:
+            if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                return done
+            time.sleep(poll)
+            continue
+
+        __work_one(broker, claimed, movie_enricher, tv_enricher)
+        done += 1
+        idle_since = time.monotonic()
+
+def enrich_distributed(programs, broker, movie_enricher, tv_enricher, timeout=None, poll=5, heartbeat=60):
+    # enrich_programs, but every unique program goes out through the broker to be picked up by
+    # any worker, this one included. Whatever isn't back by timeout seconds is written as is.
+    # heartbeat is how often (in seconds) to tell the broker we are still waiting.
+    memo = EnrichmentMemo()
+    run = uuid.uuid4().hex
+    keys = [memo.key(p) for p in programs]
+    tasks = {}
+    for p, key in zip(programs, keys):
+        task_id = __task_id(key)
+        if task_id not in tasks:
+            tasks[task_id] = __to_task(p)
+    broker.publish(run, tasks)
+    print('Published {} enrichment tasks for {} programs'.format(len(tasks), len(programs)))
+
+    started = time.monotonic()
+    last_beat = started
+    finished = 0
+    try:
+        while finished < len(tasks):
+            now = time.monotonic()
+            if timeout is not None and now - started >= timeout:
+                print('Gave up waiting on {} enrichment tasks'.format(len(tasks) - finished))
+                break
+            if now - last_beat >= heartbeat:
+                broker.heartbeat(run)
+                last_beat = now
+
+            # Pitch in while there is work, otherwise wait for everyone else
+            claimed = broker.claim('coordinator-{}'.format(os.getpid()))
+            if claimed is not None:
+                __work_one(broker, claimed, movie_enricher, tv_enricher)
+            else:
+                time.sleep(poll)
+            finished = broker.finished(run)
+
+        # Only fetch the results the once, they can be big
+        results = broker.results(run)
+    finally:
+        # Whatever happens, don't leave the workers with a run nobody is waiting on
+        broker.clear(run)
+
+    # Results go into a memo, so copying them onto every airing works the same way as locally
+    # Every program beyond the first of each task was a repeat that cost nothing
+    report = {'successes': 0, 'skipped': 0, 'skip_reasons': {}, 'tasks': len(tasks), 
+              'memo_hits': len(programs) - len(tasks),
+              'memo_hit_rate': (len(programs) - len(tasks)) / len(programs) if programs else 0}
+    reasons = {}
+    for key in set(keys):
+        result = results.get(__task_id(key))
+        if result is None:
+            reasons[key] = 'Not enriched by any worker in time'
+        elif result.get('error'):
+            reasons[key] = 'Failed on the worker ({})'.format(result['error'])
+        elif result['skipped']:
+            reasons[key] = 'Skipped by the worker'
+        else:
+            fields = result['fields']
+            if fields['airdate']:
+                fields['airdate'] = datetime.datetime.strptime(fields['airdate'], '%Y-%m-%d')
+            if not result['success'] and not key[0]:
+                del fields['episode_num']
+            memo.results[tuple(key)] = (fields, result['success'])
+
+    progs_to_write = []
+    for p, key in zip(programs, keys):
+        success = memo.lookup(key, p)
+        if success is None:
+            report['skipped'] += 1
+            report['skip_reasons'][reasons[key]] = report['skip_reasons'].get(reasons[key], 0) + 1
+            success = False
+        if not success and not key[0]:
+            p = tv_enricher.embed_stubbed_episode_info(p)
+        if success:
+            report['successes'] += 1
+        progs_to_write.append(p)
+
+    return (progs_to_write, report)
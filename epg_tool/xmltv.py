@@ -1,10 +1,13 @@
 from lxml import etree
+import bisect
+import contextlib
 import statistics
 from datetime import timedelta
 from epg_tool.channel import channel
 from epg_tool.program import program
+from epg_tool.normalize import normalize_title, normalize_text
+from epg_tool.index import guide_index, to_seconds
 from fuzzywuzzy import process, fuzz
-import pandas as pd
 
 
 def parse_xml(location):
@@ -20,10 +23,7 @@ def parse_xml(location):
         cur_channel.parse_xml(ch)
         channels[cur_channel.id] = cur_channel
 
-    # parse programs, add to list, and add to the lists which will make up the pandas array
-    index = []
-    pd_data = {'Start_Time':[], 'Stop_Time':[], 'Title':[], 'Subtitle':[], 'Channel':[], \
-            'Description':[], 'Episode':[], 'Is_Movie':[], 'Array_Index':[]}
+    # parse programs and add to list
     for p in root.findall('programme'):
         cur_program = program(title=None, start=None, stop=None, channel=None, sub_title=None, \
                             description=None, previously_shown=None, ratings=None, episode_num=None, \
@@ -31,41 +31,36 @@ def parse_xml(location):
         cur_program.parse_xml(p)
         programs.append(cur_program)
 
-        # Now create the pandas data
-        index.append(cur_program.start)
-        pd_data['Start_Time'].append(cur_program.start)
-        pd_data['Stop_Time'].append(cur_program.stop)
-        pd_data['Title'].append(cur_program.title)
-        pd_data['Subtitle'].append(cur_program.sub_title)
-        pd_data['Channel'].append(cur_program.channel)
-        pd_data['Description'].append(cur_program.description)
-        pd_data['Episode'].append(cur_program.episode_num)
-        pd_data['Array_Index'].append(len(pd_data['Array_Index']))
-    
-    df = pd.DataFrame(pd_data, \
-                      columns=['Start_Time', 'Stop_Time', 'Title', 'Subtitle', 
-                               'Channel', 'Description', 'Episode', 'Array_Index'], \
-                      index=index)
-    df.sort_index(inplace=True)
+    # The index is what the matcher actually searches through
+    return (programs, channels, guide_index.from_programs(programs))
 
-    return (programs, channels, df)
+@contextlib.contextmanager
+def open_xml_stream(location, channels):
+    # Like write_xml, but hands back a function to write programs one at a time as they
+    # become available so the whole tree never has to be built. location can also be an
+    # already open binary file (or socket).
+    if hasattr(location, 'write'):
+        xmltv_context = contextlib.nullcontext(location)
+    else:
+        xmltv_context = open(location, 'wb')
+    with xmltv_context as xmltv_file:
+        xmltv_file.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        xmltv_file.write(b'<!DOCTYPE tv SYSTEM "xmltv.dtd">\n')
 
-def write_xml(programs, channels, location):
-    # Now that we have theoretically fixed all of the data we need to output it
-    root = etree.Element('tv')
-    root.attrib['source-info-name'] = 'http://xmltv.net' 
-    root.attrib['generator-info-url'] = 'http://www.xmltv.org'
-    for ch in channels.values():
-        root.append(ch.to_xml())
-    for p in programs:
-        root.append(p.to_xml())
+        with etree.xmlfile(xmltv_file, encoding='UTF-8') as xf:
+            attrib = {'source-info-name': 'http://xmltv.net', 'generator-info-url': 'http://www.xmltv.org'}
+            with xf.element('tv', attrib):
+                xf.write('\n')
+                for ch in channels.values():
+                    xf.write(ch.to_xml(), pretty_print=True)
 
-    with open(location, 'w') as xmltv_file:
-        xmltv_file.write("<?xml version='1.0' encoding='UTF-8'?>\n")
-        xmltv_file.write('<!DOCTYPE tv SYSTEM "xmltv.dtd">\n')
+                yield lambda p: xf.write(p.to_xml(), pretty_print=True)
 
-        tree = etree.ElementTree(root)
-        xmltv_file.write(etree.tounicode(tree, pretty_print=True))
+def write_xml(programs, channels, location):
+    # Now that we have theoretically fixed all of the data we need to output it
+    with open_xml_stream(location, channels) as write_program:
+        for p in programs:
+            write_program(p)
 
 def transfer_channel_ids(to_channels, to_programs, from_channels):
     # We need to have both the channels and programs we are transfering information to.
@@ -108,17 +103,20 @@ def __int_prog_to_eit(eit_prog, int_prog):
 
     return eit_prog
 
-def __match_processor(program, search, df, internet_programs):
+def __match_processor(program, search, rows, index, internet_programs):
     if search == 'Title':
-        if program.title is None:
+        title = normalize_title(program.title)
+        if not title:
             return None
         else:
-            best_matches = process.extract(program.title, df['Title'], scorer=fuzz.ratio)
+            choices = {row: index['norm_title'][row] for row in rows if index['norm_title'][row]}
+            best_matches = process.extract(title, choices, scorer=fuzz.ratio)
     elif search == 'Description':
+        choices = {row: index['description'][row] for row in rows if index['description'][row]}
         if program.description is not None:
-            best_matches =  process.extract(program.description, df['Description'], scorer=fuzz.token_set_ratio)
+            best_matches =  process.extract(program.description, choices, scorer=fuzz.token_set_ratio)
         elif program.sub_title is not None:
-            best_matches =  process.extract(program.sub_title, df['Description'], scorer=fuzz.token_set_ratio)
+            best_matches =  process.extract(program.sub_title, choices, scorer=fuzz.token_set_ratio)
         else:
             return None
     else:
@@ -134,33 +132,21 @@ def __match_processor(program, search, df, internet_programs):
                              and best_matches[0][1] > 85:
         # If we are in title search mode, check for full duplicates, then go to description search mode
         if search == 'Title':
-            idx_1 = df.loc[best_matches[0][2]]['Array_Index']
-            idx_2 = df.loc[best_matches[1][2]]['Array_Index']
-            if isinstance(idx_1, pd.Series):
-                idx_1 = idx_1.values[0]
-            if isinstance(idx_2, pd.Series):
-                idx_2 = idx_2.values[0]
+            idx_1 = index['array_index'][best_matches[0][2]]
+            idx_2 = index['array_index'][best_matches[1][2]]
 
             if __are_progs_same(internet_programs[idx_1], internet_programs[idx_2]):
                 return idx_1
             else:
-                df = df[df['Title'] == best_matches[0][0]]
-                return __match_processor(program, 'Description', df, internet_programs)
+                rows = [row for row in rows if index['norm_title'][row] == best_matches[0][0]]
+                return __match_processor(program, 'Description', rows, index, internet_programs)
 
         elif search == 'Description':
             # In this instance it appears that the episode is played more than once.
             # We can jus return it as is!
-            idx = df.loc[best_matches[0][2]]['Array_Index']
-            if isinstance(idx, pd.Series):
-                idx = idx.values[0]
-
-            return idx
+            return index['array_index'][best_matches[0][2]]
     elif best_matches[0][1] > 85:
-        idx = df.loc[best_matches[0][2]]['Array_Index']
-        if isinstance(idx, pd.Series):
-            idx = idx.values[0]
-
-        return idx
+        return index['array_index'][best_matches[0][2]]
     
     return None
 
@@ -172,9 +158,198 @@ def __are_progs_same(prog_1, prog_2):
     else:
         return False
 
-def match_headend_to_internet(tvhd_programs, internet_programs, internet_channels, internet_df):
+def __exact_candidates(program, exact, start, td):
+    title = normalize_title(program.title)
+    if not title or (program.channel, title) not in exact:
+        return []
+    starts, idxs = exact[(program.channel, title)]
+    first = bisect.bisect_left(starts, start - td)
+    last = bisect.bisect_right(starts, start + td)
+    return list(zip(starts[first:last], idxs[first:last]))
+
+def __exact_match(program, exact, index, internet_programs, start, td):
+    candidates = __exact_candidates(program, exact, start, td)
+    if not candidates:
+        return None
+
+    # Closest airing first
+    candidates.sort(key=lambda c: abs(c[0] - start))
+    first = internet_programs[candidates[0][1]]
+    if all(__are_progs_same(first, internet_programs[c[1]]) for c in candidates[1:]):
+        return candidates[0][1]
+
+    # The same title airs more than once in the window. An identical description settles it,
+    # then the usual fuzzy description search over just those airings. Only if neither
+    # finds it do we go with the closest airing.
+    description = normalize_text(program.description)
+    if description:
+        same_desc = [c for c in candidates if normalize_text(internet_programs[c[1]].description) == description]
+        if len(same_desc) == 1:
+            return same_desc[0][1]
+
+    idxs = set(c[1] for c in candidates)
+    rows = [row for row in index.rows(program.channel, start-td, start+td) if index['array_index'][row] in idxs]
+    idx = __match_processor(program, 'Description', rows, index, internet_programs)
+    if idx is not None:
+        return idx
+
+    return candidates[0][1]
+
+def __estimate_offsets(tvhd_programs, exact, td, min_samples):
+    # Everything in here is in seconds
+    deltas = {}
+    for p in tvhd_programs:
+        # Only trust titles that show up exactly once in the window
+        candidates = __exact_candidates(p, exact, to_seconds(p.start), td)
+        if len(candidates) == 1:
+            deltas.setdefault(p.channel, []).append(candidates[0][0] - to_seconds(p.start))
+
+    offsets = {}
+    for ch, ch_deltas in deltas.items():
+        if len(ch_deltas) >= min_samples:
+            offsets[ch] = int(statistics.median(ch_deltas))
+    return offsets
+
+def estimate_channel_offsets(tvhd_programs, internet_index, min_samples=3):
+    # How far the internet guide times are from the headend times on each channel.
+    # Channels without enough unambiguous exact title matches are left out.
+    exact = internet_index.exact_titles()
+    offsets = __estimate_offsets(tvhd_programs, exact, 8*3600, min_samples)
+    return {ch: timedelta(seconds=offset) for ch, offset in offsets.items()}
+
+def __title_similarity(title_1, title_2):
+    if not title_1 or not title_2:
+        return 0
+    if title_1 == title_2:
+        return 100
+    return fuzz.ratio(title_1, title_2)
+
+def __align_channel(hd_seq, int_seq, offset, band, threshold):
+    # Both sequences are [(start, normalized title, index)] sorted by start. This is a banded
+    # Needleman-Wunsch: score[i][j] is the best total similarity from pairing up the first i
+    # headend programs with the first j internet programs without ever crossing. Row i only
+    # looks at the internet programs within band places of its (offset corrected) start time.
+    int_starts = [x[0] for x in int_seq]
+    rows = []
+    prev = None
+
+    def prev_score(j):
+        # score[i-1][j]. Anything right of the band can't have paired up with anything else, 
+        # anything left of it is just the score from before the band.
+        if prev is None:
+            return 0
+        lo, hi, scores, left, _ = prev
+        if j > hi:
+            return scores[-1]
+        if j < lo:
+            return left
+        return scores[j-lo]
+
+    for start, title, _ in hd_seq:
+        centre = bisect.bisect_left(int_starts, start + offset)
+        lo = max(centre - band, 0)
+        hi = min(centre + band, len(int_seq))
+        if prev is not None:
+            # Keep the band moving forward so everything outside of it stays easy to work out
+            lo = max(lo, prev[0])
+            hi = max(hi, prev[1])
+
+        left = prev_score(lo-1) if lo > 0 else 0
+        scores = []
+        moves = []
+        for j in range(lo, hi+1):
+            # Skip this headend program
+            best = prev_score(j)
+            move = 'up'
+
+            # Skip an internet program
+            if j > lo and scores[-1] > best:
+                best = scores[-1]
+                move = 'left'
+
+            # Pair them up - with a tiny bonus for being close in time to break ties between repeats
+            if j > 0:
+                sim = __title_similarity(title, int_seq[j-1][1])
+                if sim > threshold:
+                    dt = abs(int_seq[j-1][0] - (start + offset))
+                    score = prev_score(j-1) + sim + 1 - min(dt, 3600) / 3600
+                    if score > best:
+                        best = score
+                        move = 'diag'
+
+            scores.append(best)
+            moves.append(move)
+
+        prev = (lo, hi, scores, left, moves)
+        rows.append(prev)
+
+    # Walk back through to find which pairs made it
+    pairs = []
+    i = len(hd_seq)
+    j = len(int_seq)
+    while i > 0:
+        lo, hi, _, _, moves = rows[i-1]
+        if j > hi:
+            j = hi
+        elif j < lo:
+            i -= 1
+        elif moves[j-lo] == 'diag':
+            pairs.append((hd_seq[i-1][2], int_seq[j-1][2]))
+            i -= 1
+            j -= 1
+        elif moves[j-lo] == 'up':
+            i -= 1
+        else:
+            j -= 1
+
+    pairs.reverse()
+    return pairs
+
+def __match_sequences(tvhd_programs, internet_programs, internet_channels, internet_index, band, threshold):
     matches = []
 
+    exact = internet_index.exact_titles()
+    offsets = __estimate_offsets(tvhd_programs, exact, 8*3600, 3)
+
+    # Split the headend up into per channel schedules, the index already is
+    hd_seqs = {}
+    for i in range(len(tvhd_programs)):
+        p = tvhd_programs[i]
+        if p.channel in internet_channels and p.channel in internet_index.channels:
+            hd_seqs.setdefault(p.channel, []).append((to_seconds(p.start), normalize_title(p.title), i))
+
+    for ch, hd_seq in hd_seqs.items():
+        hd_seq.sort(key=lambda x: x[0])
+        int_seq = [(internet_index['start'][row], internet_index['norm_title'][row], internet_index['array_index'][row]) \
+                   for row in internet_index.rows(ch)]
+        offset = offsets.get(ch, 0)
+        for tvhd_idx, int_idx in __align_channel(hd_seq, int_seq, offset, band, threshold):
+            matches.append(tvhd_idx)
+            tvhd_programs[tvhd_idx] = __int_prog_to_eit(tvhd_programs[tvhd_idx], internet_programs[int_idx])
+
+    matches.sort()
+    return (tvhd_programs, matches)
+
+def match_headend_to_internet(tvhd_programs, internet_programs, internet_channels, internet_index, 
+                              window=timedelta(minutes=15), engine='window', band=10, threshold=85):
+    # engine='window' looks for each program on its own in a window around its start time.
+    # engine='sequence' aligns each channel's whole schedule in one go so matches stay in order.
+    if engine == 'sequence':
+        return __match_sequences(tvhd_programs, internet_programs, internet_channels, internet_index, 
+                                 band, threshold)
+
+    matches = []
+
+    # Look window (15 minutes) either side of the offset corrected start time. Channels we couldn't
+    # estimate an offset for are searched +/- 8 hours, and so is anything not found near where it
+    # should be. Outside of that we are just going to punt on it.
+    wide = 8*3600
+    window = int(window.total_seconds())
+    exact = internet_index.exact_titles()
+
+    # Once we know how far off a channel's times are we only need to look a few minutes either side
+    offsets = __estimate_offsets(tvhd_programs, exact, wide, 3)
+
     for i in range(len(tvhd_programs)):
         p = tvhd_programs[i]
 
@@ -182,24 +357,43 @@ def match_headend_to_internet(tvhd_programs, internet_programs, internet_channel
             # There is no channel to search on!
             continue
 
-        # Create a range of +/- 8 hours in which to look for the specified program on the channel of interest
-        # if it isn't in that time range we are just going to punt on it.
-        td = timedelta(hours=8)
-        df = internet_df.loc[(p.start-td).strftime("%Y-%m-%d %H:%M:%S"):(p.start+td).strftime("%Y-%m-%d %H:%M:%S")]
-        df = df[df['Channel'] == p.channel]
+        if p.channel in offsets:
+            start = to_seconds(p.start) + offsets[p.channel]
+            td = window
+        else:
+            start = to_seconds(p.start)
+            td = wide
+
+        # Most programs have exactly the same title once normalized - no fuzzy matching needed
+        idx = __exact_match(p, exact, internet_index, internet_programs, start, td)
+        if idx is not None:
+            matches.append(i)
+            tvhd_programs[i] = __int_prog_to_eit(p, internet_programs[idx])
+            continue
+
+        rows = internet_index.rows(p.channel, start-td, start+td)
 
-        # First do a title search
-        idx = __match_processor(p, 'Title', df, internet_programs)
-        if idx:
+        # Then do a fuzzy title search
+        idx = __match_processor(p, 'Title', rows, internet_index, internet_programs)
+        if idx is not None:
             matches.append(i)
             tvhd_programs[i] = __int_prog_to_eit(p, internet_programs[idx])
             continue
 
         # Now try a description search
-        idx = __match_processor(p, 'Description', df, internet_programs)
-        if idx:
+        idx = __match_processor(p, 'Description', rows, internet_index, internet_programs)
+        if idx is not None:
             matches.append(i)
             tvhd_programs[i] = __int_prog_to_eit(p, internet_programs[idx])
             continue
 
+        # Nothing near where it should be - it may have been moved (an overrun, a schedule change).
+        # Look wide again, but only take a title that airs just the once in all that time.
+        if td != wide:
+            candidates = __exact_candidates(p, exact, start, wide)
+            if candidates and all(__are_progs_same(internet_programs[candidates[0][1]], internet_programs[c[1]])
+                                  for c in candidates[1:]):
+                matches.append(i)
+                tvhd_programs[i] = __int_prog_to_eit(p, internet_programs[candidates[0][1]])
+
     return (tvhd_programs, matches)
@@ -18,7 +18,9 @@ setup(
         'Development Status :: 3 - Alpha'
     ],
     packages=['epg_tool'],
-    python_requires='>3.4',
+    python_requires='>=3.7',
     install_requires=install_requires,
-    scripts=['scripts/run_scheduled_xmltv_pulls', 'scripts/run_xmltv_pulls_once']
+    scripts=['scripts/run_scheduled_xmltv_pulls', 'scripts/run_xmltv_pulls_once', 
+             'scripts/run_enrichment_worker', 'scripts/run_cache_maintenance',
+             'scripts/run_batch_xmltv_pulls']
 )
\ No newline at end of file